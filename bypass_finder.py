@@ -0,0 +1,121 @@
+"""
+Bounded-depth search of a bypass used by neighbor_function_1 - a path from start to goal, not going through
+the avoided vertex, with at most max_depth edges.
+
+BypassFinder keeps, for the lifetime of the road layout:
+- a k-hop index - for every vertex used as a start, hop distances of the vertices within k edges (computed
+  lazily by BFS, k grows when a deeper search is requested). If the goal is farther than max_depth hops,
+  no bypass exists and the search fails immediately,
+- a memo of (start, avoid, goal, max_depth) searches known to fail.
+The search itself is the same depth-first search as before (same order of visiting, so the same bypass is found),
+with a set of visited vertices and parent pointers instead of copied path lists.
+"""
+
+from collections import deque
+
+BYPASS_MEMO_SIZE = 100_000  # Maximum number of remembered failed searches
+HOP_INDEX_SIZE = 10_000  # Maximum number of vertices with remembered hop distances
+
+
+class BypassFinder:
+    def __init__(self, graph, memo_size=BYPASS_MEMO_SIZE, index_size=HOP_INDEX_SIZE):
+        self.graph = graph
+        self.memo_size = memo_size
+        self.index_size = index_size
+        self.graph_version = graph.version
+        self.hop_index = {}  # Vertex.id -> (k, {Vertex.id: hop distance}) for vertices within k hops
+        self.infeasible = set()  # (start.id, avoid.id, goal.id, max_depth) of searches that found no bypass
+
+    def _check_graph(self):
+        if self.graph.version != self.graph_version:  # Graph was modified - index and memo may be outdated
+            self.hop_index.clear()
+            self.infeasible.clear()
+            self.graph_version = self.graph.version
+
+    def hop_distances(self, vertex, k):
+        """
+        Hop distances from vertex to all vertices within k edges (dictionary Vertex.id -> distance).
+        """
+        k = int(k)
+        entry = self.hop_index.get(vertex.id)
+        if entry is not None and entry[0] >= k:
+            return entry[1]
+
+        distances = {vertex.id: 0}
+        queue = deque([vertex])
+        while queue:
+            current = queue.popleft()
+            depth = distances[current.id]
+            if depth == k:
+                continue
+            for neighbor in current.neighbors:
+                if neighbor.id not in distances:
+                    distances[neighbor.id] = depth + 1
+                    queue.append(neighbor)
+
+        if len(self.hop_index) >= self.index_size:
+            self.hop_index.clear()
+        self.hop_index[vertex.id] = (k, distances)
+        return distances
+
+    def find(self, start, goal, max_depth, avoid):
+        """
+        Returns a list of edges from start to goal avoiding the vertex avoid, or an empty list if the search
+        finds no route within max_depth edges.
+        """
+        self._check_graph()
+
+        key = (start.id, avoid.id, goal.id, max_depth)
+        if key in self.infeasible:
+            return []
+
+        if start != goal:
+            hop_distance = self.hop_distances(start, max_depth).get(goal.id)
+            if hop_distance is None or hop_distance > max_depth:  # Goal too far even without avoiding anything
+                self._remember_infeasible(key)
+                return []
+
+        path = self._depth_first_search(start, goal, max_depth, avoid)
+        if path is None:
+            self._remember_infeasible(key)
+            return []
+        return path
+
+    def _remember_infeasible(self, key):
+        if len(self.infeasible) >= self.memo_size:
+            self.infeasible.clear()
+        self.infeasible.add(key)
+
+    def _depth_first_search(self, start, goal, max_depth, avoid):
+        visited = {avoid}  # Set of visited vertices (the avoided vertex counts as visited)
+        # Stack entries: (vertex, depth, link), link -> (edge, previous link) chain of the path, None for start
+        stack = [(start, 0, None)]
+
+        while stack:
+            current_vertex, depth, link = stack.pop()
+
+            if depth > max_depth:
+                continue
+            if current_vertex == goal:
+                path = []
+                while link is not None:
+                    edge, link = link
+                    path.append(edge)
+                path.reverse()
+                return path  # List of edges forming the path
+            if current_vertex in visited:
+                continue
+
+            visited.add(current_vertex)
+            if depth + 1 > max_depth:
+                continue  # Neighbors would be deeper than max_depth
+
+            # Add neighbors to the stack
+            for neighbor in current_vertex.neighbors:
+                if neighbor not in visited:
+                    # Find the edge connecting `current` and `neighbor`
+                    edge = self.graph.get_edge(current_vertex, neighbor)
+                    if edge:
+                        stack.append((neighbor, depth + 1, (edge, link)))
+
+        return None
@@ -0,0 +1,238 @@
+"""
+Danger evaluation engines used by RoadClearingProblem.
+
+The danger of a solution only depends on, for every street and every stage, whether the street was cleared
+by any machine in that stage. Streets are undirected - clearing A -> B also clears B -> A, the same way
+Edge.__eq__ treats them. Both engines work on integer IDs: routes are read from Machine.route_ids
+(edge IDs) and every edge is mapped to its Edge.street_id.
+"""
+
+from collections import defaultdict
+import numpy as np
+
+
+def accumulated_snow(cleared_pattern, snowfall_forecast):
+    """
+    Returns the snow level of a street summed over all stages.
+
+    :param cleared_pattern: sequence of clearing counts (or booleans) per stage
+    :param snowfall_forecast: snowfall in each stage
+    """
+    snow_level = 0
+    total = 0
+    for cleared, snowfall in zip(cleared_pattern, snowfall_forecast):
+        if cleared:
+            snow_level = 0
+        else:
+            snow_level += snowfall
+        total += snow_level
+    return total
+
+
+class IncrementalDangerEvaluator:
+    """
+    Delta evaluation of the danger level.
+
+    Keeps, for every street, the number of times it is cleared in each stage together with its current
+    contribution to the total danger. When the routes change, only the streets whose clearing pattern
+    changed are recomputed.
+
+    Usage in the annealing loop:
+    - reset(machines) -> full evaluation of the starting solution,
+    - propose(machines) -> danger of the modified solution (the change is kept as pending),
+    - commit() -> the pending change becomes the current state (solution accepted).
+    A rejected proposal is simply discarded by the next propose/reset.
+    """
+
+    def __init__(self, road_layout, snowfall_forecast):
+        self.snowfall_forecast = list(snowfall_forecast)
+        self.num_stages = len(self.snowfall_forecast)
+
+        self.edge_street = [edge.street_id for edge in road_layout.edges]  # edge ID -> street ID
+
+        # Weight of a street = sum of the danger weights (priority * lanes) of all graph edges representing it
+        self.weights = [0] * len(road_layout.street_index)
+        for edge in road_layout.edges:
+            self.weights[edge.street_id] += edge.get_danger_weight()
+
+        self.clear_counts = []  # street ID -> clearing count per stage
+        self.contributions = []  # street ID -> danger of the street summed over stages
+        self.total_danger = 0
+        self._routes = []  # Committed routes - list (machine) of lists (stage) of arrays of edge IDs
+        self._pending = None
+
+    def _snapshot(self, machines):
+        return [[m.route_ids[stage] if stage < len(m.route_ids) else ()
+                 for stage in range(self.num_stages)] for m in machines]
+
+    def _contribution(self, street, counts):
+        return accumulated_snow(counts, self.snowfall_forecast) * self.weights[street]
+
+    def _route_changes(self, machines):
+        # Compares all stages of all machines with the committed routes
+        new_routes = self._snapshot(machines)
+        if len(new_routes) != len(self._routes):
+            return None
+
+        changed_stages = []  # (stage, old edges, new edges)
+        for old_machine, new_machine in zip(self._routes, new_routes):
+            for stage, (old_stage, new_stage) in enumerate(zip(old_machine, new_machine)):
+                if old_stage is not new_stage and old_stage != new_stage:
+                    changed_stages.append((stage, old_stage, new_stage))
+        return new_routes, changed_stages
+
+    def _move_changes(self, machines, move):
+        # Compares only the stages of the machine changed by the move
+        machine_idx = next((idx for idx, m in enumerate(machines) if m is move.machine), None)
+        if machine_idx is None or len(machines) != len(self._routes):
+            return None
+
+        new_routes = list(self._routes)
+        new_routes[machine_idx] = list(self._routes[machine_idx])
+        last_stage = move.first_stage + max(len(move.old_stages), len(move.new_stages))
+
+        route = move.machine.route_ids
+        changed_stages = []
+        for stage in range(move.first_stage, min(last_stage, self.num_stages)):
+            new_stage = route[stage] if stage < len(route) else ()
+            changed_stages.append((stage, new_routes[machine_idx][stage], new_stage))
+            new_routes[machine_idx][stage] = new_stage
+        return new_routes, changed_stages
+
+    def reset(self, machines):
+        """
+        Evaluates the whole solution from scratch and makes it the current state.
+        :return: Total danger level.
+        """
+        self._routes = self._snapshot(machines)
+        self._pending = None
+        self.clear_counts = [[0] * self.num_stages for _ in self.weights]
+
+        for machine_routes in self._routes:
+            for stage, stage_route in enumerate(machine_routes):
+                for edge_id in stage_route:
+                    self.clear_counts[self.edge_street[edge_id]][stage] += 1
+
+        self.contributions = [self._contribution(street, counts) for street, counts in enumerate(self.clear_counts)]
+        self.total_danger = sum(self.contributions)
+        return self.total_danger
+
+    def propose(self, machines, move=None):
+        """
+        Calculates the danger of the current routes of the machines, recomputing only the streets
+        whose clearing pattern differs from the committed state.
+        If the RouteMove that produced the routes is given, only the stages it changed are compared.
+        :return: Total danger level of the proposed solution.
+        """
+        if move is not None:
+            changed = self._move_changes(machines, move)
+        else:
+            changed = self._route_changes(machines)
+        if changed is None:
+            self.reset(machines)
+            return self.total_danger
+        new_routes, changed_stages = changed
+
+        count_changes = defaultdict(int)  # (street, stage) -> change of the clearing count
+        edge_street = self.edge_street
+        for stage, old_stage, new_stage in changed_stages:
+            for edge_id in old_stage:
+                count_changes[(edge_street[edge_id], stage)] -= 1
+            for edge_id in new_stage:
+                count_changes[(edge_street[edge_id], stage)] += 1
+
+        new_counts = {}
+        for (street, stage), change in count_changes.items():
+            if change == 0:
+                continue
+            if street not in new_counts:
+                new_counts[street] = list(self.clear_counts[street])
+            new_counts[street][stage] += change
+
+        new_contributions = {}
+        danger = self.total_danger
+        for street, counts in new_counts.items():
+            # Only a change between cleared / not cleared affects the danger
+            if [c > 0 for c in counts] == [c > 0 for c in self.clear_counts[street]]:
+                new_contributions[street] = self.contributions[street]
+                continue
+            new_contributions[street] = self._contribution(street, counts)
+            danger += new_contributions[street] - self.contributions[street]
+
+        self._pending = (new_routes, new_counts, new_contributions, danger)
+        return danger
+
+    def commit(self):
+        """
+        Accepts the last proposed solution as the current state.
+        """
+        if self._pending is None:
+            return
+        self._routes, new_counts, new_contributions, self.total_danger = self._pending
+        for street, counts in new_counts.items():
+            self.clear_counts[street] = counts
+        for street, contribution in new_contributions.items():
+            self.contributions[street] = contribution
+        self._pending = None
+
+
+class VectorizedDangerSimulator:
+    """
+    NumPy implementation of RoadClearingProblem.simulate_danger.
+
+    Every graph edge (dense edge ID) has a weight (Edge.get_danger_weight, priority * lanes). Machine routes are turned into
+    a stage x street boolean matrix of cleared streets, and the snow level of every edge in every stage
+    is the cumulative snowfall since the last stage in which it was cleared.
+
+    It has the same reset/propose/commit interface as IncrementalDangerEvaluator, but it keeps no state -
+    every call is a full (vectorized) simulation.
+    """
+
+    def __init__(self, road_layout, snowfall_forecast):
+        self.snowfall_forecast = list(snowfall_forecast)
+        self.num_stages = len(self.snowfall_forecast)
+
+        self.num_streets = len(road_layout.street_index)
+        self.edge_street = np.array([edge.street_id for edge in road_layout.edges], dtype=np.int64)  # edge ID -> street ID
+        self.weights = np.array([edge.get_danger_weight() for edge in road_layout.edges])
+
+        # Cumulative snowfall with a leading 0, so that snowfall in stages (L, s] = cumulative[s + 1] - cumulative[L + 1]
+        self.cumulative_snowfall = np.concatenate(([0], np.cumsum(self.snowfall_forecast)))
+        self.total_danger = 0
+
+    def cleared_matrix(self, machines):
+        """
+        Returns boolean matrix (stage x street) of streets cleared by any machine in each stage.
+        """
+        cleared = np.zeros((self.num_stages, self.num_streets), dtype=bool)
+        for m in machines:
+            for stage, stage_route in enumerate(m.route_ids[:self.num_stages]):
+                if stage_route:
+                    cleared[stage, self.edge_street[np.asarray(stage_route)]] = True
+        return cleared
+
+    def simulate(self, machines):
+        """
+        :return: Total danger level of the routes of the machines.
+        """
+        if len(self.edge_street) == 0 or self.num_stages == 0:
+            return 0
+
+        cleared = self.cleared_matrix(machines)[:, self.edge_street]  # stage x edge
+
+        # Index of the last stage (up to the current one) in which the edge was cleared, -1 if never
+        stages = np.arange(self.num_stages)[:, None]
+        last_cleared = np.maximum.accumulate(np.where(cleared, stages, -1), axis=0)
+
+        snow_level = self.cumulative_snowfall[stages + 1] - self.cumulative_snowfall[last_cleared + 1]
+        return (snow_level.sum(axis=0) * self.weights).sum().item()
+
+    def reset(self, machines):
+        self.total_danger = self.simulate(machines)
+        return self.total_danger
+
+    def propose(self, machines, move=None):
+        return self.simulate(machines)
+
+    def commit(self):
+        pass
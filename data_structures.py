@@ -1,13 +1,56 @@
 import math
-import matplotlib.pyplot as plt
-import networkx as nx
+from collections import OrderedDict
+from functools import lru_cache
 from geopy.distance import geodesic
 
+# matplotlib i networkx są importowane dopiero w metodach rysujących - sam model grafu
+# (np. w trybie wsadowym bez wyświetlacza) ich nie potrzebuje.
+# scipy jest importowane dopiero przy pierwszym liczeniu drzewa najkrótszych ścieżek.
+
+DISTANCE_CACHE_SIZE = 100_000  # Maksymalna liczba zapamiętanych par punktów dla odległości geodezyjnej
+SHORTEST_PATH_CACHE_SIZE = 64  # Maksymalna liczba zapamiętanych drzew najkrótszych ścieżek (jedno na źródło)
+
+# Domyślna polityka łączenia powtórzonych ulic przy imporcie (Graph.merge_edge):
+# atrybut krawędzi -> funkcja (dotychczasowa wartość, nowa wartość) -> wartość po połączeniu
+DEFAULT_MERGE_POLICY = {"priority": max, "lanes": max}
+
+
+def _geodesic_km(coords_a, coords_b):
+    return geodesic(coords_a, coords_b).meters / 1000  # Odległość w kilometrach
+
+
+# Ograniczony cache LRU odległości geodezyjnych - heurystyki A* wielokrotnie liczą odległość do tego samego celu
+geodesic_km = lru_cache(maxsize=DISTANCE_CACHE_SIZE)(_geodesic_km)
+
+
+def set_distance_cache_size(maxsize):
+    """
+    Zmienia rozmiar cache odległości geodezyjnych (czyści jego zawartość i liczniki).
+    """
+    global geodesic_km
+    geodesic_km = lru_cache(maxsize=maxsize)(_geodesic_km)
+
+
+def distance_cache_info():
+    """
+    Zwraca statystyki cache odległości: trafienia, chybienia, współczynnik trafień, rozmiar.
+    """
+    info = geodesic_km.cache_info()
+    calls = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": info.hits / calls if calls else 0.0,
+        "size": info.currsize,
+        "maxsize": info.maxsize,
+    }
+
 
 class Vertex:  # Obrazuje poczatek/koniec ulicy lub skrzyzowanie ulic
     def __init__(self, x, y, true_location=True):
         self.x = x
         self.y = y 
+        self.id = None  # Indeks w Graph.vertices, nadawany przez graf
         self.neighbors = []  # Lista sąsiednich wierzcholkow
         self.true_location = true_location
 
@@ -35,25 +78,32 @@ class Vertex:  # Obrazuje poczatek/koniec ulicy lub skrzyzowanie ulic
             coords_self = (self.y, self.x)  # (latitude, longitude) dla bieżącego punktu
             coords_other = (other.y, other.x)  # (latitude, longitude) dla punktu 'other'
 
-            # Oblicz odległość geodezyjną między dwoma punktami
-            return geodesic(coords_self, coords_other).meters / 1000  # Odległość w kilometrach
+            # Oblicz odległość geodezyjną między dwoma punktami (z cache)
+            return geodesic_km(coords_self, coords_other)
 
         else:
             return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2)
 
 
 class Edge:  # Obrazuje ulice polaczona przez dwa wierzcholki
-    def __init__(self, start, end, priority=0, lanes=1, true_location=True):
+    def __init__(self, start, end, priority=0, lanes=1, true_location=True, length=None):
         self.start = start
         self.end = end
         self.priority = priority   # priorytet w zakresie 0-100
         self.lanes = lanes  # ilosc pasow
         self.true_location = true_location
         self.snow_level = 0
-        self.length = self.calculate_length()
+        self.id = None  # Indeks krawędzi w Graph.edges, nadawany przez graf
+        self.street_id = None  # Identyfikator ulicy (niezależny od kierunku), nadawany przez graf
+        self.length = length  # Jeśli długość jest znana (np. przy odtwarzaniu grafu), nie liczymy jej ponownie
+        self.danger_weight = None  # Waga ulicy w ocenie zagrożenia, None -> priority * lanes
+        self.calculate_length()
 
     def calculate_length(self):
-        return self.start.get_distance(self.end)
+        # Długość liczona jest tylko raz - później korzystamy z zapamiętanej wartości self.length
+        if self.length is None:
+            self.length = self.start.get_distance(self.end)
+        return self.length
 
     def __repr__(self):
         return f"{self.start} -> {self.end}"
@@ -63,8 +113,14 @@ class Edge:  # Obrazuje ulice polaczona przez dwa wierzcholki
         return (self.start == other.start and self.end == other.end) or \
                (self.start == other.end and self.end == other.start)
 
+    def get_danger_weight(self):
+        # Krawędź ściągniętego łańcucha waży tyle, co wszystkie jego odcinki (graph_contraction)
+        if self.danger_weight is not None:
+            return self.danger_weight
+        return self.priority * self.lanes
+
     def get_danger_level(self):
-        return self.snow_level * self.priority * self.lanes
+        return self.snow_level * self.get_danger_weight()
     
     def __hash__(self):
         # Hashowanie powinno uwzględniać tylko unikalne krawędzie, niezależnie od kierunku
@@ -72,32 +128,83 @@ class Edge:  # Obrazuje ulice polaczona przez dwa wierzcholki
 
 
 class Graph:  # Obrazuje pelny rozklad ulic/skrzyzowan
-    def __init__(self, true_location=True):
+    def __init__(self, true_location=True, snap_tolerance=None):
         self.vertices = []
         self.edges = []
         self.baza = None  # Punkt początkowy (baza)
         self.true_location = true_location
 
+        # Indeks wierzchołków (x, y) -> Vertex. Jeśli podano snap_tolerance, punkty odległe o co najwyżej
+        # snap_tolerance (w jednostkach współrzędnych) są traktowane jako ten sam wierzchołek - przydatne
+        # dla zmiennoprzecinkowych współrzędnych z OSM. Do wyszukiwania służy siatka komórek o boku snap_tolerance.
+        self.snap_tolerance = snap_tolerance
+        self.vertex_index = {}
+        self._vertex_cells = {}
+
+        # Indeksy aktualizowane przez add_edge:
+        # (x1, y1), (x2, y2) -> pierwsza dodana krawędź między tymi punktami
+        # (x, y) -> lista krawędzi wychodzących z wierzchołka (w kolejności dodawania)
+        self.edge_index = {}
+        self.outgoing_edges = {}
+
+        # Gęsta numeracja: krawędź -> edge.id (indeks w self.edges), ulica -> edge.street_id.
+        # Krawędzie A -> B i B -> A (oraz powtórzone krawędzie) to ta sama ulica, tak jak w Edge.__eq__.
+        self.street_index = {}
+
+        # Drzewa najkrótszych ścieżek: id źródła -> (odległości, poprzednicy), liczone na macierzy CSR grafu.
+        # Czyszczone przy każdej zmianie grafu (nowy wierzchołek lub krawędź), która zwiększa też version -
+        # po niej zewnętrzne pamięci podręczne (np. DetourCache) wiedzą, że muszą się wyczyścić.
+        self.version = 0
+        self._csr = None
+        self._shortest_path_trees = OrderedDict()
+
+    def _cell(self, x, y):
+        return math.floor(x / self.snap_tolerance), math.floor(y / self.snap_tolerance)
+
+    def find_vertex(self, x, y):
+        """
+        Zwraca istniejący wierzchołek o podanych współrzędnych (z uwzględnieniem snap_tolerance) lub None.
+        """
+        vertex = self.vertex_index.get((x, y))
+        if vertex is not None or not self.snap_tolerance:
+            return vertex
+
+        cell_x, cell_y = self._cell(x, y)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for candidate in self._vertex_cells.get((cell_x + dx, cell_y + dy), []):
+                    if math.hypot(candidate.x - x, candidate.y - y) <= self.snap_tolerance:
+                        return candidate
+        return None
+
+    def _register_vertex(self, vertex):
+        self._invalidate_shortest_paths()
+        vertex.id = len(self.vertices)
+        self.vertices.append(vertex)
+        self.vertex_index[(vertex.x, vertex.y)] = vertex
+        if self.snap_tolerance:
+            self._vertex_cells.setdefault(self._cell(vertex.x, vertex.y), []).append(vertex)
+
     def add_base(self, x, y):
         # Sprawdzenie, czy wierzchołek o podanych współrzędnych już istnieje
-        for vertex in self.vertices:
-            if vertex.x == x and vertex.y == y:
-                self.baza = vertex  # Ustaw bazę na istniejący wierzchołek
-                return
-            
+        vertex = self.find_vertex(x, y)
+        if vertex is not None:
+            self.baza = vertex  # Ustaw bazę na istniejący wierzchołek
+            return
+
         # Jeśli wierzchołek nie istnieje, dodaj nowy jako bazę
         self.baza = Vertex(x, y, self.true_location)
-        self.vertices.append(self.baza)
+        self._register_vertex(self.baza)
 
     def add_vertex(self, x, y):
         # Sprawdzanie, czy wierzchołek o tych współrzędnych już istnieje
-        for wierzcholek in self.vertices:
-            if wierzcholek.x == x and wierzcholek.y == y:
-                return wierzcholek  # Zwróć istniejący wierzchołek
+        wierzcholek = self.find_vertex(x, y)
+        if wierzcholek is not None:
+            return wierzcholek  # Zwróć istniejący wierzchołek
 
         # Jeśli wierzchołek nie istnieje, stwórz nowy
         nowy_wierzcholek = Vertex(x, y, self.true_location)
-        self.vertices.append(nowy_wierzcholek)
+        self._register_vertex(nowy_wierzcholek)
         return nowy_wierzcholek
 
     def get_edge(self, point1, point2):
@@ -118,22 +225,22 @@ class Graph:  # Obrazuje pelny rozklad ulic/skrzyzowan
         if isinstance(point2, Vertex):
             point2 = (point2.x, point2.y)
 
-        for edge in self.edges:
-            # Sprawdzamy, czy punkt1 jest początkiem krawędzi, a punkt2 końcem
-            if (edge.start.x, edge.start.y) == point1 and (edge.end.x, edge.end.y) == point2:
-                return edge
+        # Przy włączonym przyciąganiu punkty mogą nie pokrywać się dokładnie ze współrzędnymi wierzchołków
+        if self.snap_tolerance:
+            vertex1 = self.find_vertex(*point1)
+            vertex2 = self.find_vertex(*point2)
+            if vertex1 is None or vertex2 is None:
+                return None
+            point1 = (vertex1.x, vertex1.y)
+            point2 = (vertex2.x, vertex2.y)
 
-        return None  # Jeśli nie znaleziono krawędzi
+        return self.edge_index.get((point1, point2))  # None, jeśli nie znaleziono krawędzi
     
     def get_edges_from_vertex(self, wierzcholek):
         """
         Zwraca listę krawędzi wychodzących z danego wierzchołka.
         """
-        edges = []
-        for edge in self.edges:
-            if edge.start == wierzcholek:
-                edges.append(edge)
-        return edges
+        return list(self.outgoing_edges.get((wierzcholek.x, wierzcholek.y), []))
 
     def add_edge(self, punkt1, punkt2, priorytet, pasy):
         # Dodaje krawędź do grafu między punktami (x1, y1) a (x2, y2), uwzględniając kierunek.
@@ -141,16 +248,212 @@ class Graph:  # Obrazuje pelny rozklad ulic/skrzyzowan
         w1 = self.add_vertex(*punkt1)
         w2 = self.add_vertex(*punkt2)
 
+        if w1 is w2 and tuple(punkt1) != tuple(punkt2):
+            return  # Oba końce zostały przyciągnięte do tego samego wierzchołka - pomijamy zerową krawędź
+
         edge_1 = Edge(w1, w2, priorytet, pasy, self.true_location)
-        self.edges.append(edge_1)
+        self._index_edge(edge_1)
 
         edge_2 = Edge(w2, w1, priorytet, pasy, self.true_location)
-        self.edges.append(edge_2)
+        self._index_edge(edge_2)
 
         # Powiąż krawędź z wierzchołkami
         w1.add_neighbor(w2)
         w2.add_neighbor(w1)
 
+    def merge_edge(self, punkt1, punkt2, priorytet, pasy, merge_policy=None):
+        """
+        Dodaje ulicę tak jak add_edge, ale jeśli między tymi wierzchołkami (w dowolnym kierunku) jest już ulica,
+        nie tworzy nowych krawędzi - łączy atrybuty istniejących krawędzi obu kierunków według merge_policy.
+
+        Args:
+        - merge_policy: słownik atrybut -> funkcja (stara wartość, nowa wartość), None -> DEFAULT_MERGE_POLICY
+
+        Returns:
+        - True, jeśli ulica została połączona z istniejącą (żadna krawędź nie została dodana)
+        """
+        merge_policy = merge_policy or DEFAULT_MERGE_POLICY
+        w1 = self.find_vertex(*punkt1)
+        w2 = self.find_vertex(*punkt2)
+        if w1 is None or w2 is None or (self.get_edge(w1, w2) is None and self.get_edge(w2, w1) is None):
+            self.add_edge(punkt1, punkt2, priorytet, pasy)
+            return False
+
+        new_values = {"priority": priorytet, "lanes": pasy}
+        for start, end in ((w1, w2), (w2, w1)):
+            for edge in self.outgoing_edges.get((start.x, start.y), []):
+                if edge.end is end:
+                    for attribute, merge in merge_policy.items():
+                        setattr(edge, attribute, merge(getattr(edge, attribute), new_values[attribute]))
+        return True
+
+    def _index_edge(self, edge):
+        # Dodaje krawędź do listy krawędzi i do indeksów
+        self._invalidate_shortest_paths()
+        start = (edge.start.x, edge.start.y)
+        end = (edge.end.x, edge.end.y)
+        edge.id = len(self.edges)
+        edge.street_id = self.street_index.setdefault((start, end) if start <= end else (end, start),
+                                                      len(self.street_index))
+        self.edges.append(edge)
+        self.edge_index.setdefault((start, end), edge)
+        self.outgoing_edges.setdefault(start, []).append(edge)
+
+    def _invalidate_shortest_paths(self):
+        self.version += 1
+        self._csr = None
+        self._shortest_path_trees.clear()
+
+    def to_csr(self):
+        """
+        Eksportuje graf do macierzy sąsiedztwa scipy.sparse.csr_matrix (wiersz/kolumna = Vertex.id).
+        Wagą przejścia z wierzchołka do sąsiada jest długość krawędzi zwracanej przez get_edge - tej samej,
+        której używają funkcje sąsiedztwa.
+        """
+        if self._csr is None:
+            from scipy.sparse import csr_matrix
+
+            indptr, indices, weights = [0], [], []
+            for vertex in self.vertices:
+                for neighbor in vertex.neighbors:
+                    indices.append(neighbor.id)
+                    weights.append(self.get_edge(vertex, neighbor).length)
+                indptr.append(len(indices))
+            n = len(self.vertices)
+            self._csr = csr_matrix((weights, indices, indptr), shape=(n, n))
+        return self._csr
+
+    def shortest_path_tree(self, source):
+        """
+        Zwraca drzewo najkrótszych ścieżek z wierzchołka source (algorytm Dijkstry z scipy.sparse.csgraph).
+        Drzewo jest liczone raz i zapamiętywane do czasu zmiany grafu.
+
+        Returns:
+        - distances: tablica odległości od source (indeks = Vertex.id, inf dla nieosiągalnych)
+        - predecessors: tablica poprzedników na najkrótszej ścieżce (-9999 dla source i nieosiągalnych)
+        """
+        tree = self._shortest_path_trees.get(source.id)
+        if tree is not None:
+            self._shortest_path_trees.move_to_end(source.id)
+            return tree
+
+        from scipy.sparse.csgraph import dijkstra
+
+        tree = dijkstra(self.to_csr(), directed=True, indices=source.id, return_predecessors=True)
+        self._shortest_path_trees[source.id] = tree
+        if len(self._shortest_path_trees) > SHORTEST_PATH_CACHE_SIZE:
+            self._shortest_path_trees.popitem(last=False)
+        return tree
+
+    def shortest_path(self, source, target):
+        """
+        Najkrótsza ścieżka z source do target jako lista krawędzi (odtwarzana z drzewa najkrótszych ścieżek
+        w czasie proporcjonalnym do jej długości) lub None, jeśli target jest nieosiągalny.
+        """
+        distances, predecessors = self.shortest_path_tree(source)
+        if math.isinf(distances[target.id]):
+            return None
+
+        path = []
+        current = target.id
+        while current != source.id:
+            previous = predecessors[current]
+            path.append(self.get_edge(self.vertices[previous], self.vertices[current]))
+            current = previous
+        path.reverse()
+        return path
+
+    @classmethod
+    def from_arrays(cls, vertex_xy, neighbor_indptr, neighbor_indices, edge_endpoints, priority, lanes, length,
+                    snow_level=None, base=None, true_location=True, snap_tolerance=None, danger_weight=None):
+        """
+        Tworzy graf z płaskich tablic (np. wczytanych przez graph_store.load_graph) - bez liczenia długości
+        i bez wyszukiwania wierzchołków po współrzędnych. Kolejność wierzchołków, sąsiadów i krawędzi jest
+        zachowana, więc Vertex.id i Edge.id są takie same jak w grafie, z którego powstały tablice.
+
+        Args:
+        - vertex_xy: współrzędne wierzchołków, kształt (n, 2)
+        - neighbor_indptr, neighbor_indices: listy sąsiadów w formacie CSR (indeksy wierzchołków)
+        - edge_endpoints: indeksy początku i końca krawędzi, kształt (m, 2)
+        - priority, lanes, length, snow_level: atrybuty krawędzi (snow_level None -> 0)
+        - danger_weight: wagi zagrożenia krawędzi (Edge.danger_weight) lub None -> priority * lanes;
+          w np.ma.MaskedArray zamaskowane wagi są pomijane (None)
+        - base: indeks bazy lub None
+        """
+        graph = cls(true_location, snap_tolerance)
+        for x, y in vertex_xy.tolist():  # tolist -> liczby Pythona zamiast skalarów NumPy
+            graph._register_vertex(Vertex(x, y, true_location))
+
+        vertices = graph.vertices
+        indptr = neighbor_indptr.tolist()
+        indices = neighbor_indices.tolist()
+        for i, vertex in enumerate(vertices):
+            vertex.neighbors = [vertices[j] for j in indices[indptr[i]:indptr[i + 1]]]
+
+        # Krawędzie indeksowane jak w _index_edge, ale bez unieważniania pamięci podręcznych przy każdej z nich
+        graph._invalidate_shortest_paths()
+        coords = [(vertex.x, vertex.y) for vertex in vertices]
+        edges = graph.edges
+        edge_index = graph.edge_index
+        outgoing_edges = graph.outgoing_edges
+        street_index = graph.street_index
+        snow_levels = snow_level.tolist() if snow_level is not None else [0] * len(edge_endpoints)
+        danger_weights = danger_weight.tolist() if danger_weight is not None else [None] * len(edge_endpoints)
+        for (start, end), edge_priority, edge_lanes, edge_length, edge_snow, edge_weight in zip(
+                edge_endpoints.tolist(), priority.tolist(), lanes.tolist(), length.tolist(), snow_levels,
+                danger_weights):
+            edge = Edge(vertices[start], vertices[end], edge_priority, edge_lanes, true_location, edge_length)
+            edge.snow_level = edge_snow
+            edge.danger_weight = edge_weight
+            edge.id = len(edges)
+            start_xy = coords[start]
+            end_xy = coords[end]
+            street = (start_xy, end_xy) if start_xy <= end_xy else (end_xy, start_xy)
+            street_id = street_index.get(street)
+            if street_id is None:
+                street_id = street_index[street] = len(street_index)
+            edge.street_id = street_id
+            edges.append(edge)
+            if (start_xy, end_xy) not in edge_index:
+                edge_index[(start_xy, end_xy)] = edge
+            outgoing = outgoing_edges.get(start_xy)
+            if outgoing is None:
+                outgoing = outgoing_edges[start_xy] = []
+            outgoing.append(edge)
+
+        if base is not None:
+            graph.baza = vertices[base]
+        return graph
+
+    def __getstate__(self):
+        # Płaska reprezentacja grafu (indeksy zamiast obiektów) - pickle nie schodzi rekurencyjnie
+        # po listach sąsiadów, co dla dużych grafów przekraczało limit rekurencji.
+        # Używane przy przekazywaniu grafu do procesów roboczych oraz przez copy.deepcopy.
+        vertex_idx = {id(w): i for i, w in enumerate(self.vertices)}
+        return {
+            "true_location": self.true_location,
+            "snap_tolerance": self.snap_tolerance,
+            "vertices": [(w.x, w.y) for w in self.vertices],
+            "neighbors": [[vertex_idx[id(n)] for n in w.neighbors] for w in self.vertices],
+            "edges": [(vertex_idx[id(k.start)], vertex_idx[id(k.end)], k.priority, k.lanes, k.length, k.snow_level,
+                       k.danger_weight) for k in self.edges],
+            "baza": vertex_idx[id(self.baza)] if self.baza is not None else None,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state["true_location"], state["snap_tolerance"])
+        for x, y in state["vertices"]:
+            self._register_vertex(Vertex(x, y, self.true_location))
+        for w, neighbors in zip(self.vertices, state["neighbors"]):
+            w.neighbors = [self.vertices[i] for i in neighbors]
+        for start, end, priority, lanes, length, snow_level, danger_weight in state["edges"]:
+            edge = Edge(self.vertices[start], self.vertices[end], priority, lanes, self.true_location, length)
+            edge.snow_level = snow_level
+            edge.danger_weight = danger_weight
+            self._index_edge(edge)
+        if state["baza"] is not None:
+            self.baza = self.vertices[state["baza"]]
+
     def __repr__(self):
         result = "Graf:\n"
         for edge in self.edges:
@@ -175,6 +478,8 @@ class Graph:  # Obrazuje pelny rozklad ulic/skrzyzowan
         - edge_width: grubość linii (krawędzi).
         - show_edge_labels: czy wyświetlać tekst (etykiety) na krawędziach.
         """
+        import matplotlib.pyplot as plt
+        import networkx as nx
 
         G = nx.Graph()
 
@@ -262,10 +567,13 @@ class Graph:  # Obrazuje pelny rozklad ulic/skrzyzowan
         ax.legend()
 
     def draw_with_solution(self, rozwiazanie: list, ax=None, size_x=10, size_y=10, show_coords=True, decimal_places=2, show_labels=True, node_size=600, label_font_size=10,
-                           edge_width=2, show_edge_labels=True):
+                           edge_width=2, show_edge_labels=True, segments=None):
         """
         Rysuje graf z zaznaczeniem określonych krawędzi w rozwiązaniu.
         - rozwiazanie: lista list krawędzi (rozwiazanie dla jednej maszyny).
+        - segments: funkcja krawędź -> lista krawędzi tego grafu, którymi jest rysowana, np.
+          ChainContraction.segments dla rozwiązania z grafu ściągniętego przez graph_contraction
+          (rysowanego na oryginalnym grafie).
         - size_x, size_y: rozmiar wykresu.
         - show_coords: czy wyświetlać współrzędne węzłów.
         - decimal_places: do ilu miejsc po przecinku zaokrąglać współrzędne.
@@ -275,6 +583,8 @@ class Graph:  # Obrazuje pelny rozklad ulic/skrzyzowan
         - edge_width: grubość linii krawędzi.
         - show_edge_labels: czy wyświetlać etykiety na krawędziach.
         """
+        import matplotlib.pyplot as plt
+        import networkx as nx
 
         # Ustawienia kolorów dla etapów
         kolory_etapow = ['black', 'brown', 'green', 'blue', 'purple', 'red', 'pink', 'orange']
@@ -343,6 +653,9 @@ class Graph:  # Obrazuje pelny rozklad ulic/skrzyzowan
         for idx, etap in enumerate(rozwiazanie):
             kolor = kolory_etapow[idx % len(kolory_etapow)]
             grubosc = max(edge_width*3 - idx, edge_width / 2)  # dynamiczna grubość linii dla etapu
+            # Krawędzie ściągniętych łańcuchów rysujemy jako odcinki oryginalnego grafu
+            if segments is not None:
+                etap = [segment for edge in etap for segment in segments(edge)]
             for edge in etap:
                 edge_tuple = (edge.start.x, edge.start.y, edge.end.x, edge.end.y)
                 reverse_edge_tuple = (edge.end.x, edge.end.y, edge.start.x, edge.start.y)
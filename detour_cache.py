@@ -0,0 +1,150 @@
+"""
+Detours used by change_path - the shortest path from the start to the end of an edge that does not use the edge.
+
+The edges of the road layout do not change during a run, so the detour of every edge is found once and kept
+in a DetourCache (keyed by edge ID, bounded, least recently used entries are dropped first). The cache is
+filled lazily, or up front with DetourCache.precompute, which spreads the searches over a process pool.
+"""
+
+import heapq
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+DETOUR_CACHE_SIZE = 100_000  # Maximum number of edges whose detour is kept
+
+_worker_graph = None  # Road layout of a precomputation worker process, unpickled once per process
+
+
+def repair_path_A_star(removed_edge, graph):
+    """
+    A* search of the path from removed_edge.start to removed_edge.end avoiding removed_edge (in both directions).
+    :return: list of edges or None if there is no detour
+    """
+    open_set = []
+    heapq.heappush(open_set, (0, removed_edge.start))  # Kolejka priorytetowa
+    closed_set = set()  # Zbiór odwiedzonych węzłów
+    came_from = {}  # Przechowuje ścieżkę (z wierzchołka na wierzchołek)
+    g_score = {removed_edge.start: 0}  # Koszt dotarcia (brak wpisu -> nieskończoność)
+
+    while open_set:
+        _, current = heapq.heappop(open_set)
+
+        # Jeśli dotarliśmy do celu, rekonstruujemy ścieżkę
+        if current == removed_edge.end:
+            path = []
+            while current in came_from:
+                prev_node = came_from[current]
+                edge = graph.get_edge(prev_node, current)
+                path.append(edge)
+                current = prev_node
+            return path[::-1]  # Odwróć kolejność, by zaczynać od startu
+
+        # Dodaj węzeł do zbioru odwiedzonych
+        closed_set.add(current)
+
+        # Iterujemy po sąsiadach wierzchołka
+        for neighbor in current.neighbors:
+            edge = graph.get_edge(current, neighbor)
+
+            # Ignorujemy krawędź usuniętą
+            if edge == removed_edge:
+                continue
+
+            # Ignorujemy węzły już odwiedzone
+            if neighbor in closed_set:
+                continue
+
+            # Oblicz koszt przejścia
+            tentative_g_score = g_score[current] + edge.length
+
+            if tentative_g_score < g_score.get(neighbor, float('inf')):
+                came_from[neighbor] = current  # Zaktualizuj ścieżkę
+                g_score[neighbor] = tentative_g_score
+                f_score = tentative_g_score + neighbor.get_distance(removed_edge.end)  # Heurystyka (odległość do celu)
+                heapq.heappush(open_set, (f_score, neighbor))
+
+    return None  # Jeśli nie znaleziono ścieżki
+
+
+def _init_detour_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _find_detours(edge_ids):
+    # Runs in a worker process - detours as tuples of edge IDs (None -> no detour)
+    detours = []
+    for edge_id in edge_ids:
+        path = repair_path_A_star(_worker_graph.edges[edge_id], _worker_graph)
+        detours.append(None if path is None else tuple(edge.id for edge in path))
+    return detours
+
+
+class DetourCache:
+    def __init__(self, road_layout, maxsize=DETOUR_CACHE_SIZE):
+        self.road_layout = road_layout
+        self.maxsize = maxsize
+        self.detours = OrderedDict()  # edge ID -> tuple of edge IDs of the detour or None
+        self.graph_version = road_layout.version
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, edge_id, detour):
+        self.detours[edge_id] = detour
+        if len(self.detours) > self.maxsize:
+            self.detours.popitem(last=False)
+
+    def _check_graph(self):
+        if self.road_layout.version != self.graph_version:  # Graph was modified - detours may be outdated
+            self.detours.clear()
+            self.graph_version = self.road_layout.version
+
+    def get(self, edge):
+        """
+        Returns the detour of the edge as a new list of edges, None if there is none.
+        """
+        self._check_graph()
+        try:
+            detour = self.detours[edge.id]
+            self.detours.move_to_end(edge.id)
+            self.hits += 1
+        except KeyError:
+            path = repair_path_A_star(edge, self.road_layout)
+            detour = None if path is None else tuple(edge.id for edge in path)
+            self._store(edge.id, detour)
+            self.misses += 1
+
+        if detour is None:
+            return None
+        return [self.road_layout.edges[edge_id] for edge_id in detour]
+
+    def precompute(self, edge_ids=None, max_workers=None):
+        """
+        Finds the detours of the given edges (default - all edges, at most maxsize of them) in a process pool.
+        """
+        self._check_graph()
+        if edge_ids is None:
+            edge_ids = range(len(self.road_layout.edges))
+        edge_ids = [edge_id for edge_id in edge_ids if edge_id not in self.detours][:self.maxsize]
+        if not edge_ids:
+            return
+
+        n_chunks = min(len(edge_ids), 4 * (max_workers or os.cpu_count() or 1))
+        chunks = [edge_ids[i::n_chunks] for i in range(n_chunks)]
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_detour_worker,
+                                 initargs=(self.road_layout,)) as executor:
+            results = executor.map(_find_detours, chunks)
+            for chunk, detours in zip(chunks, results):
+                for edge_id, detour in zip(chunk, detours):
+                    self._store(edge_id, detour)
+
+    def info(self):
+        calls = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / calls if calls else 0.0,
+            "size": len(self.detours),
+            "maxsize": self.maxsize,
+        }
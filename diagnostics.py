@@ -32,17 +32,24 @@ def prev_plot(event):
         update_plot(ax, current_plot[0])
 
 
-def plot_diagnostic_charts(danger, best_danger, temperature):
-    """Draws interactive diagnostic charts."""
+def plot_diagnostic_charts(danger, best_danger, temperature, iterations=None):
+    """Draws interactive diagnostic charts.
+
+    iterations -> iteration numbers of the points of every series (list of 3 lists - histories of long runs are
+    decimated by DiagnosticsRecorder and every series keeps its own extremes), None -> consecutive iterations.
+    """
     global plots, fig, ax  # Reference to global variables
 
+    if iterations is None:
+        iterations = [range(len(series)) for series in (danger, best_danger, temperature)]
+
     # Update plot data
     plots = [
-        {"title": "Danger level achieved in each iteration", "x": range(len(danger)), "y": danger,
+        {"title": "Danger level achieved in each iteration", "x": iterations[0], "y": danger,
          "ylabel": "Danger"},
-        {"title": "Accepted danger level", "x": range(len(best_danger)), "y": best_danger,
+        {"title": "Accepted danger level", "x": iterations[1], "y": best_danger,
          "ylabel": "Danger"},
-        {"title": "Temperature", "x": range(len(temperature)), "y": temperature, "ylabel": ""},
+        {"title": "Temperature", "x": iterations[2], "y": temperature, "ylabel": ""},
     ]
     current_plot[0] = 0  # Reset plot index
 
@@ -0,0 +1,162 @@
+"""
+Bounded storage of the annealing diagnostics (danger, accepted danger and temperature per iteration).
+
+The recorder keeps at most `capacity` buckets in preallocated NumPy arrays. While the run is short every bucket
+holds a single iteration and the history is exact. When the buckets run out, neighboring buckets are merged
+pairwise (the bucket size doubles). All stored buckets have the same size - points of an incomplete bucket wait
+in `pending` until it fills up. Every bucket keeps the minimum and the maximum of every series together with
+the indices of the points where they occurred, so peaks and drops survive the decimation at their true positions.
+Memory use does not depend on the number of iterations.
+
+Full-resolution data can optionally be streamed to a .npy file (memory-mapped, readable with
+np.load(path, mmap_mode='r')), one row per recorded point. The file is allocated for stream_length points,
+rows after the last recorded point stay zero when the run stops early.
+"""
+
+import numpy as np
+
+DIAGNOSTICS_CAPACITY = 5000  # Default number of buckets -> at most 2 * 5000 points per series
+FLUSH_SIZE = 1024  # Points collected in a Python list before they are moved to the NumPy arrays
+
+
+class DiagnosticsRecorder:
+    def __init__(self, n_series=3, capacity=DIAGNOSTICS_CAPACITY, stream_path=None, stream_length=None):
+        """
+        :param n_series: number of values passed to every record() call
+        :param capacity: maximum number of buckets kept in memory (rounded down to an even number, so that
+                         a full set of buckets merges pairwise without a leftover)
+        :param stream_path: .npy file receiving every recorded point (full resolution), None -> no streaming
+        :param stream_length: maximum number of points of the stream file (required with stream_path)
+        """
+        if capacity < 2:
+            raise ValueError("Diagnostics capacity must be at least 2")
+        if stream_path is not None and stream_length is None:
+            raise ValueError("stream_length is required when streaming diagnostics to a file")
+
+        self.n_series = n_series
+        self.capacity = capacity - capacity % 2
+        self.bucket_size = 1  # Number of points in every stored bucket
+        self.count = 0  # Number of filled buckets
+        self.n_points = 0  # Number of points stored in the buckets
+
+        self.first = np.empty(self.capacity, dtype=np.int64)  # Index of the first point of every bucket
+        self.low = np.empty((self.capacity, n_series))
+        self.high = np.empty((self.capacity, n_series))
+        self.low_at = np.empty((self.capacity, n_series), dtype=np.int64)  # Index of the point with the minimum
+        self.high_at = np.empty((self.capacity, n_series), dtype=np.int64)  # Index of the point with the maximum
+
+        self.pending = []  # Points (tuples) not stored in the buckets yet - at most one incomplete bucket after a flush
+
+        self.stream = None
+        self.n_streamed = 0
+        if stream_path is not None:
+            self.stream = np.lib.format.open_memmap(stream_path, mode="w+", dtype=np.float64,
+                                                    shape=(stream_length, n_series))
+
+    def record(self, *values):
+        self.pending.append(values)
+        if len(self.pending) >= max(FLUSH_SIZE, self.bucket_size):
+            self._flush()
+
+    def __len__(self):
+        return self.n_points + len(self.pending)
+
+    @staticmethod
+    def _buckets(points, start, bucket_size):
+        """
+        Splits points (array n x n_series, n a multiple of bucket_size, first point has index start) into buckets.
+        Also used for a single incomplete bucket (bucket_size = n).
+        :return: first, low, high, low_at, high_at arrays
+        """
+        groups = points.reshape(-1, bucket_size, points.shape[1])
+        first = start + bucket_size * np.arange(len(groups))
+        return (first, groups.min(axis=1), groups.max(axis=1),
+                first[:, None] + groups.argmin(axis=1), first[:, None] + groups.argmax(axis=1))
+
+    def _merge_pairs(self):
+        """
+        Merges neighboring buckets pairwise (count is even - all buckets are full), doubling the bucket size.
+        """
+        n_pairs = self.count // 2
+        a = slice(0, 2 * n_pairs, 2)
+        b = slice(1, 2 * n_pairs, 2)
+
+        low_in_a = self.low[a] <= self.low[b]  # On a tie the earlier point is kept
+        high_in_a = self.high[a] >= self.high[b]
+        merged = (self.first[a].copy(), np.minimum(self.low[a], self.low[b]), np.maximum(self.high[a], self.high[b]),
+                  np.where(low_in_a, self.low_at[a], self.low_at[b]),
+                  np.where(high_in_a, self.high_at[a], self.high_at[b]))
+        for array, values in zip((self.first, self.low, self.high, self.low_at, self.high_at), merged):
+            array[:n_pairs] = values
+
+        self.count = n_pairs
+        self.bucket_size *= 2
+
+    def _flush(self):
+        if not self.pending:
+            return
+        points = np.array(self.pending, dtype=np.float64)
+
+        if self.stream is not None:
+            # Pending points of an incomplete bucket were already streamed by the previous flush
+            new = points[self.n_streamed - self.n_points:]
+            end = min(self.n_streamed + len(new), len(self.stream))
+            self.stream[self.n_streamed:end] = new[:end - self.n_streamed]
+            self.n_streamed += len(new)
+
+        used = 0
+        while len(points) - used >= self.bucket_size:
+            if self.count == self.capacity:
+                self._merge_pairs()
+                continue
+            n_buckets = min((len(points) - used) // self.bucket_size, self.capacity - self.count)
+            size = n_buckets * self.bucket_size
+            buckets = self._buckets(points[used:used + size], self.n_points, self.bucket_size)
+            end = self.count + n_buckets
+            for array, values in zip((self.first, self.low, self.high, self.low_at, self.high_at), buckets):
+                array[self.count:end] = values
+            self.count = end
+            self.n_points += size
+            used += size
+
+        self.pending = self.pending[used:]
+
+    def close(self):
+        """
+        Moves complete buckets from pending to the arrays and flushes the stream file.
+        """
+        self._flush()
+        if self.stream is not None:
+            self.stream.flush()
+
+    def series(self):
+        """
+        Returns the (decimated) history as lists: one list of values per series and, as the last item, a list with
+        the point indices of every series. A bucket gives the minimum and the maximum of every series at the indices
+        where they occurred (one point if they are the same point). The incomplete last bucket is included.
+        """
+        self.close()
+        buckets = [array[:self.count] for array in (self.first, self.low, self.high, self.low_at, self.high_at)]
+        if self.pending:
+            tail = self._buckets(np.array(self.pending, dtype=np.float64), self.n_points, len(self.pending))
+            buckets = [np.concatenate((stored, extra)) for stored, extra in zip(buckets, tail)]
+        _, low, high, low_at, high_at = buckets
+
+        values = []
+        positions = []
+        for k in range(self.n_series):
+            both = low_at[:, k] != high_at[:, k]
+            low_first = low_at[:, k] < high_at[:, k]
+            repeats = np.where(both, 2, 1)
+            starts = np.cumsum(repeats) - repeats
+
+            series_positions = np.empty(int(repeats.sum()), dtype=np.int64)
+            series_values = np.empty(len(series_positions))
+            series_positions[starts] = np.where(low_first, low_at[:, k], high_at[:, k])
+            series_values[starts] = np.where(low_first, low[:, k], high[:, k])
+            series_positions[starts[both] + 1] = np.where(low_first, high_at[:, k], low_at[:, k])[both]
+            series_values[starts[both] + 1] = np.where(low_first, high[:, k], low[:, k])[both]
+
+            values.append(series_values.tolist())
+            positions.append(series_positions.tolist())
+        return values + [positions]
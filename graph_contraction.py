@@ -0,0 +1,170 @@
+"""
+Contraction of chains of degree-2 vertices (e.g. a curved OSM street split into many segments) into super-edges.
+
+ChainContraction(graph).graph is a smaller Graph on which the optimizer can run: every chain of vertices with
+exactly two neighbors between two kept vertices becomes one street whose length is the length of the chain,
+priority the length-weighted priority of its edges and lanes/snow level the largest along the chain. Its danger
+weight (Edge.danger_weight) is the sum of the weights of the streets of the chain, so the danger of a solution
+is the same on the contracted graph and, after expanding the routes, on the original one. Vertices
+with another number of neighbors and the base are kept. A chain whose ends are already connected (or which
+returns to its start) keeps one or two of its vertices, so the contracted graph has at most one street between
+two vertices, like the original one.
+
+ChainContraction keeps the original edges of every contracted edge (expansion): expand_machines converts routes
+found on the contracted graph back to the original edges and segments can be passed to
+Graph.draw_with_solution of the original graph. The contracted graph itself holds no references to the original
+one, so it can be pickled (e.g. for the workers of parallel_annealing) on its own.
+"""
+
+from array import array
+
+import numpy as np
+
+from data_structures import Graph
+
+
+class ChainContraction:
+    def __init__(self, graph):
+        self.original = graph
+        self.kept = self._kept_vertices()  # IDs of the original vertices present in the contracted graph
+        self.expansion = []  # Contracted edge ID -> tuple of the original edge IDs it stands for
+        self.graph = self._contract()
+
+    def _walk(self, start, first):
+        # Follows the chain start -> first -> ... up to the next kept vertex: interior vertices and that vertex
+        interior = []
+        previous, current = start, first
+        while current.id not in self.kept:
+            interior.append(current)
+            a, b = current.neighbors
+            previous, current = current, (b if a is previous else a)
+        return interior, current
+
+    def _kept_vertices(self):
+        vertices = self.original.vertices
+        self.kept = {vertex.id for vertex in vertices if len(vertex.neighbors) != 2}
+        if self.original.baza is not None:
+            self.kept.add(self.original.baza.id)
+
+        # Pairs of kept vertices connected by a street of the contracted graph
+        connected = {frozenset((vertex.id, neighbor.id)) for vertex in vertices if vertex.id in self.kept
+                     for neighbor in vertex.neighbors if neighbor.id in self.kept}
+        in_chain = set()
+
+        def resolve_chain(start, first):
+            interior, end = self._walk(start, first)
+            if not interior or interior[0].id in in_chain:
+                return  # Direct street or a chain already resolved from its other end
+            in_chain.update(vertex.id for vertex in interior)
+
+            pair = frozenset((start.id, end.id))
+            if start is not end and pair not in connected:
+                connected.add(pair)
+                return
+            # start -> ... -> last -> end instead of a parallel street or a loop (loop: start -> first -> ... -> last)
+            last = interior[-1]
+            self.kept.add(last.id)
+            connected.update((frozenset((start.id, last.id)), frozenset((last.id, end.id))))
+            if start is end:
+                self.kept.add(interior[0].id)
+                connected.update((frozenset((start.id, interior[0].id)), frozenset((interior[0].id, last.id))))
+
+        for vertex in vertices:
+            if vertex.id in self.kept:
+                for neighbor in vertex.neighbors:
+                    resolve_chain(vertex, neighbor)
+
+        # Cycles made only of degree-2 vertices - one of their vertices is kept
+        for vertex in vertices:
+            if vertex.id not in self.kept and vertex.id not in in_chain:
+                self.kept.add(vertex.id)
+                resolve_chain(vertex, vertex.neighbors[0])
+
+        return self.kept
+
+    def _contract(self):
+        original = self.original
+        kept_vertices = [vertex for vertex in original.vertices if vertex.id in self.kept]
+        new_id = {vertex.id: i for i, vertex in enumerate(kept_vertices)}
+
+        neighbor_indptr = [0]
+        neighbor_indices = []
+        for vertex in kept_vertices:
+            for neighbor in vertex.neighbors:
+                neighbor_indices.append(new_id[self._walk(vertex, neighbor)[1].id])
+            neighbor_indptr.append(len(neighbor_indices))
+
+        # Danger weight of every direction between two vertices, including repeated edges (skipped below)
+        directed_weight = {}
+        for edge in original.edges:
+            key = (edge.start.id, edge.end.id)
+            directed_weight[key] = directed_weight.get(key, 0) + edge.get_danger_weight()
+
+        endpoints, priority, lanes, length, snow_level, danger_weight = [], [], [], [], [], []
+        for edge in original.edges:
+            if edge.start.id not in self.kept:
+                continue
+            if edge.end.id in self.kept:
+                path = [edge]
+            elif edge is original.get_edge(edge.start, edge.end):
+                interior, end = self._walk(edge.start, edge.end)
+                chain = [edge.start] + interior + [end]
+                path = [original.get_edge(a, b) for a, b in zip(chain, chain[1:])]
+            else:
+                continue  # Repeated edge along a chain - the chain is contracted from its first edge
+
+            total_length = sum(segment.length for segment in path)
+            endpoints.append((new_id[path[0].start.id], new_id[path[-1].end.id]))
+            if len(path) == 1 or total_length == 0:
+                priority.append(max(segment.priority for segment in path))
+            else:
+                priority.append(round(sum(segment.priority * segment.length for segment in path) / total_length))
+            lanes.append(max(segment.lanes for segment in path))
+            length.append(total_length)
+            snow_level.append(max(segment.snow_level for segment in path))
+            if len(path) == 1:
+                danger_weight.append(edge.get_danger_weight())
+            else:
+                danger_weight.append(sum(directed_weight[(segment.start.id, segment.end.id)] for segment in path))
+            self.expansion.append(tuple(segment.id for segment in path))
+
+        graph = Graph.from_arrays(
+            np.array([(vertex.x, vertex.y) for vertex in kept_vertices]).reshape(-1, 2),
+            np.array(neighbor_indptr, dtype=np.int64), np.array(neighbor_indices, dtype=np.int32),
+            np.array(endpoints, dtype=np.int32).reshape(-1, 2), np.array(priority), np.array(lanes),
+            np.array(length, dtype=np.float64), np.array(snow_level),
+            base=new_id[original.baza.id] if original.baza is not None else None,
+            true_location=original.true_location, snap_tolerance=original.snap_tolerance,
+            danger_weight=np.array(danger_weight))
+        return graph
+
+    def segments(self, edge):
+        """
+        Edges of the original graph which the edge of the contracted graph stands for.
+        """
+        return [self.original.edges[edge_id] for edge_id in self.expansion[edge.id]]
+
+    def expand_route_ids(self, route_ids):
+        """
+        Converts stages of edge IDs of the contracted graph to stages of edge IDs of the original graph.
+        """
+        return [array('i', [edge_id for contracted_id in stage for edge_id in self.expansion[contracted_id]])
+                for stage in route_ids]
+
+    def expand_machines(self, machines):
+        """
+        Moves the routes of machines planned on the contracted graph to the original graph (in place).
+        """
+        for machine in machines:
+            if machine.road_layout is self.graph:
+                machine.route_ids = self.expand_route_ids(machine.route_ids)
+                machine.road_layout = self.original
+        return machines
+
+    def info(self):
+        return {
+            "vertices": len(self.original.vertices),
+            "contracted_vertices": len(self.graph.vertices),
+            "edges": len(self.original.edges),
+            "contracted_edges": len(self.graph.edges),
+        }
@@ -0,0 +1,171 @@
+"""
+Binary format of the road layout - a directory of flat NumPy arrays:
+
+    vertex_xy.npy         (n, 2)  coordinates of the vertices (in the order of Vertex.id)
+    neighbor_indptr.npy   (n + 1) neighbor lists in the CSR form (indices of the vertices)
+    neighbor_indices.npy
+    edge_endpoints.npy    (m, 2)  indices of the start and end vertex (in the order of Edge.id)
+    edge_priority.npy     (m)
+    edge_lanes.npy        (m)
+    edge_length.npy       (m)
+    edge_snow_level.npy   (m)
+    edge_danger_weight.npy      (m)  Edge.get_danger_weight() of every edge
+    edge_danger_weight_set.npy  (m)  whether Edge.danger_weight is set (e.g. contracted chains), False -> None
+    meta.json             format version, true_location, snap_tolerance, index of the base
+
+Graphs saved in format version 1 (without the danger weight arrays) are still loaded, with no danger weights set.
+
+save_graph writes the arrays to a new version subdirectory of the given directory and then atomically replaces
+the small pointer file 'current' with its name, so a reader (e.g. of the OSM cache) always sees a complete graph,
+also while another process saves a new one. The replaced version is kept (a reader may have just read
+the pointer), older ones are removed - load_graph reads the pointer again if a version disappears while it is
+being opened.
+
+The arrays are opened with np.load(mmap_mode='r'), so processes loading the same layout share one page-cached
+copy of the file and no Python objects are unpickled. Vertex and edge IDs of the loaded graph are the same
+as in the saved one, so routes (arrays of edge IDs) can be exchanged between processes that loaded the layout.
+"""
+
+import gc
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from data_structures import Graph
+
+GRAPH_FORMAT_VERSION = 2
+_ARRAYS = ("vertex_xy", "neighbor_indptr", "neighbor_indices", "edge_endpoints", "edge_priority", "edge_lanes",
+           "edge_length", "edge_snow_level", "edge_danger_weight", "edge_danger_weight_set")
+_ARRAYS_V1 = _ARRAYS[:8]
+_POINTER = "current"  # File with the name of the version subdirectory of the saved graph
+
+
+def graph_to_arrays(graph):
+    """
+    Returns the flat arrays (dictionary name -> array) and metadata of the graph.
+    """
+    vertex_idx = {id(vertex): i for i, vertex in enumerate(graph.vertices)}
+    neighbor_counts = [len(vertex.neighbors) for vertex in graph.vertices]
+
+    arrays = {
+        "vertex_xy": np.array([(vertex.x, vertex.y) for vertex in graph.vertices]).reshape(-1, 2),
+        "neighbor_indptr": np.concatenate(([0], np.cumsum(neighbor_counts, dtype=np.int64))),
+        "neighbor_indices": np.fromiter((vertex_idx[id(neighbor)] for vertex in graph.vertices
+                                         for neighbor in vertex.neighbors), dtype=np.int32, count=sum(neighbor_counts)),
+        "edge_endpoints": np.array([(vertex_idx[id(edge.start)], vertex_idx[id(edge.end)]) for edge in graph.edges],
+                                   dtype=np.int32).reshape(-1, 2),
+        "edge_priority": np.array([edge.priority for edge in graph.edges]),
+        "edge_lanes": np.array([edge.lanes for edge in graph.edges]),
+        "edge_length": np.array([edge.length for edge in graph.edges], dtype=np.float64),
+        "edge_snow_level": np.array([edge.snow_level for edge in graph.edges]),
+        "edge_danger_weight": np.array([edge.get_danger_weight() for edge in graph.edges]),
+        "edge_danger_weight_set": np.array([edge.danger_weight is not None for edge in graph.edges], dtype=bool),
+    }
+    meta = {
+        "version": GRAPH_FORMAT_VERSION,
+        "true_location": graph.true_location,
+        "snap_tolerance": graph.snap_tolerance,
+        "base": vertex_idx[id(graph.baza)] if graph.baza is not None else None,
+    }
+    return arrays, meta
+
+
+def save_graph(graph, path):
+    """
+    Saves the graph to the directory path (created if needed). An existing graph in the directory is replaced
+    atomically - readers see either the old or the new graph.
+    """
+    arrays, meta = graph_to_arrays(graph)
+    path = os.path.abspath(path)
+    os.makedirs(path, exist_ok=True)
+    previous = _current_version(path)
+
+    # Written under a temporary name, renamed to a version just before the pointer is switched to it
+    temporary_path = os.path.join(path, f".tmp-{os.getpid()}-{time.time_ns()}")
+    os.makedirs(temporary_path)
+    for name in _ARRAYS:
+        np.save(os.path.join(temporary_path, name + ".npy"), arrays[name])
+    with open(os.path.join(temporary_path, "meta.json"), "w") as file:
+        json.dump(meta, file)
+    version = f"v{time.time_ns()}-{os.getpid()}"
+    os.rename(temporary_path, os.path.join(path, version))
+
+    temporary_pointer = os.path.join(path, f".{_POINTER}-{os.getpid()}.tmp")
+    with open(temporary_pointer, "w") as file:
+        file.write(version)
+    os.replace(temporary_pointer, os.path.join(path, _POINTER))
+
+    # Versions older than the replaced one are no longer read by anybody (versions of concurrent saves are newer)
+    if previous is not None:
+        for entry in os.listdir(path):
+            if entry.startswith("v") and _version_time(entry) < _version_time(previous):
+                shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+
+
+def _version_time(version):
+    return int(version[1:].split("-")[0])
+
+
+def _current_version(path):
+    try:
+        with open(os.path.join(path, _POINTER), "r") as file:
+            return file.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _graph_directory(path):
+    # Directory with the arrays of the current version
+    version = _current_version(path)
+    return os.path.join(path, version) if version else path
+
+
+def load_graph(path, mmap_mode="r"):
+    """
+    Loads a graph saved by save_graph.
+
+    :param mmap_mode: passed to np.load, None -> read the arrays into memory
+    :return: Graph object
+    """
+    while True:
+        version = _current_version(path)
+        directory = os.path.join(path, version) if version else path
+        try:
+            with open(os.path.join(directory, "meta.json"), "r") as file:
+                meta = json.load(file)
+            names = _ARRAYS_V1 if meta.get("version") == 1 else _ARRAYS
+            # Mapped (or read) arrays stay valid even if the version is removed afterwards
+            arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode) for name in names}
+            break
+        except FileNotFoundError:
+            if version is None or _current_version(path) == version:
+                raise
+            # The version was replaced and removed by concurrent saves while it was being opened - read the new one
+
+    if meta.get("version") not in (1, GRAPH_FORMAT_VERSION):
+        raise ValueError(f"Unsupported graph format version {meta.get('version')} in '{path}'")
+
+    danger_weight = None
+    if "edge_danger_weight" in arrays:
+        # Masked entries (danger_weight None) become None in Graph.from_arrays (MaskedArray.tolist)
+        danger_weight = np.ma.masked_array(arrays["edge_danger_weight"], mask=~arrays["edge_danger_weight_set"])
+
+    # Only new objects are created - garbage collections triggered by them would find nothing to free
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return Graph.from_arrays(arrays["vertex_xy"], arrays["neighbor_indptr"], arrays["neighbor_indices"],
+                                 arrays["edge_endpoints"], arrays["edge_priority"], arrays["edge_lanes"],
+                                 arrays["edge_length"], arrays["edge_snow_level"], base=meta["base"],
+                                 true_location=meta["true_location"], snap_tolerance=meta["snap_tolerance"],
+                                 danger_weight=danger_weight)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def is_saved_graph(path):
+    return os.path.isfile(os.path.join(_graph_directory(path), "meta.json"))
@@ -1,6 +1,20 @@
-from data_structures import Graph
-import osmnx as ox
+from data_structures import Graph, DEFAULT_MERGE_POLICY
+from graph_store import save_graph, load_graph, is_saved_graph
+import gc
+import hashlib
+import json
+import logging
 import math
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Graphs built from OSM are stored here (one file per query), so opening the same area again does not query
+# OSM nor rebuild the graph. The directory can be changed with the ROAD_CLEARING_CACHE_DIR environment variable.
+OSM_CACHE_DIR = os.environ.get("ROAD_CLEARING_CACHE_DIR",
+                               os.path.join(os.path.expanduser("~"), ".cache", "road_clearing", "osm"))
+OSM_CACHE_VERSION = 3  # Increase when the way graphs are built from OSM data changes - old entries are not used
 
 
 def calculate_euclidean_distance(x1, y1, x2, y2):
@@ -76,7 +90,8 @@ def calculate_lanes(edge_data):
 
 
 def get_osm_graph_from_point(center_point, dist=800, dist_type="bbox", network_type="drive", main_roads=False,
-                             custom_roads=None):
+                             custom_roads=None, snap_tolerance=None, use_cache=True, offline=False, cache_dir=None,
+                             merge_duplicates=True, merge_policy=None, report=None):
     """
     Retrieves map section from OSM around given point (center_point)
     within radius dist (in meters) and creates a 'Graph' object.
@@ -88,6 +103,11 @@ def get_osm_graph_from_point(center_point, dist=800, dist_type="bbox", network_t
     - network_type: 'drive', 'walk', 'bike' etc.
     - main_roads: bool, if True -> retrieve only main road categories
     - custom_roads: list of strings, e.g., ["motorway", "primary", "secondary"], for custom filter
+    - snap_tolerance: nodes closer than this (in degrees) are merged into one vertex, None -> exact coordinates
+    - use_cache: look the query up in the on-disk cache (OSM_CACHE_DIR) first and store newly built graphs there
+    - offline: serve only from the cache, FileNotFoundError if the query is not cached
+    - cache_dir: cache directory, None -> OSM_CACHE_DIR
+    - merge_duplicates, merge_policy, report: see add_streets
 
     Returns: 'Graph' object
     """
@@ -108,6 +128,19 @@ def get_osm_graph_from_point(center_point, dist=800, dist_type="bbox", network_t
         # No filter
         custom_filter = None
 
+    cache_key = osm_cache_key(center_point, dist, dist_type, network_type, custom_filter, snap_tolerance,
+                              (merge_policy or DEFAULT_MERGE_POLICY) if merge_duplicates else None)
+    if use_cache:
+        graph = load_cached_graph(cache_key, cache_dir)
+        if graph is not None:
+            logger.info("OSM graph loaded from cache (%s)", cache_key)
+            return graph
+    if offline:
+        raise FileNotFoundError(f"Offline mode: no cached graph for {center_point}, dist={dist}, "
+                                f"dist_type={dist_type}, network_type={network_type}, filter={custom_filter}")
+
+    import osmnx as ox  # Imported here - loading text layouts (e.g. in batch mode) does not need OSMnx
+
     G_osm = ox.graph_from_point(
         center_point,
         dist=dist,
@@ -116,7 +149,31 @@ def get_osm_graph_from_point(center_point, dist=800, dist_type="bbox", network_t
         custom_filter=custom_filter
     )
 
-    graph = Graph()
+    graph = graph_from_osm(G_osm, center_point, dist, snap_tolerance, merge_duplicates, merge_policy, report)
+    if use_cache:
+        save_cached_graph(graph, cache_key, cache_dir)
+    return graph
+
+
+def get_osm_graph_from_graphml(filepath, center_point, dist=800, snap_tolerance=None, merge_duplicates=True,
+                               merge_policy=None, report=None):
+    """
+    Creates a 'Graph' object from an OSM graph saved with osmnx.save_graphml (e.g. a local fixture),
+    without querying OSM. center_point and dist are used for priorities, as in get_osm_graph_from_point.
+    """
+    import osmnx as ox
+
+    return graph_from_osm(ox.load_graphml(filepath), center_point, dist, snap_tolerance, merge_duplicates,
+                          merge_policy, report)
+
+
+def graph_from_osm(G_osm, center_point, dist, snap_tolerance=None, merge_duplicates=True, merge_policy=None,
+                   report=None):
+    """
+    Converts an OSMnx graph to a 'Graph' object (priorities and lanes derived from OSM attributes).
+    Two-way streets are stored in OSM as two directed edges - with merge_duplicates they become one street.
+    """
+    graph = Graph(snap_tolerance=snap_tolerance)
 
     # add base
     if len(G_osm.nodes) > 0:
@@ -127,57 +184,170 @@ def get_osm_graph_from_point(center_point, dist=800, dist_type="bbox", network_t
 
     center_lat, center_lon = center_point
     max_distance = dist
-    for u, v, key, data in G_osm.edges(keys=True, data=True):
-        x_u = G_osm.nodes[u]["x"]
-        y_u = G_osm.nodes[u]["y"]
-        x_v = G_osm.nodes[v]["x"]
-        y_v = G_osm.nodes[v]["y"]
 
-        priority = calculate_priority(data, x_u, y_u, x_v, y_v, center_lon, center_lat, max_distance)
-        lanes = calculate_lanes(data)
+    def streets():
+        for u, v, key, data in G_osm.edges(keys=True, data=True):
+            x_u = G_osm.nodes[u]["x"]
+            y_u = G_osm.nodes[u]["y"]
+            x_v = G_osm.nodes[v]["x"]
+            y_v = G_osm.nodes[v]["y"]
 
-        graph.add_edge((x_u, y_u), (x_v, y_v), priority, lanes)
+            priority = calculate_priority(data, x_u, y_u, x_v, y_v, center_lon, center_lat, max_distance)
+            lanes = calculate_lanes(data)
 
+            yield (x_u, y_u), (x_v, y_v), priority, lanes
+
+    add_streets(graph, streets(), merge_duplicates, merge_policy, report)
     return graph
 
 
-# Function to load a graph from a given street layout file 'street_layout.txt',
-# where the data is represented in the following format:
-# (vertex_1) (vertex_2) priority lanes
+def add_streets(graph, streets, merge_duplicates=True, merge_policy=None, report=None):
+    """
+    Adds streets ((x1, y1), (x2, y2), priority, lanes) to the graph.
+
+    Parameters:
+    - merge_duplicates: a street repeated between the same vertices (in either direction) is merged into
+      the existing one (Graph.merge_edge) instead of adding another pair of edges
+    - merge_policy: how attributes of merged streets are combined, None -> DEFAULT_MERGE_POLICY (max priority, max lanes)
+    - report: dictionary filled with the number of streets read, collapsed duplicates and resulting edges
+    """
+    n_streets = 0
+    collapsed = 0
+    for start_point, end_point, priority, lanes in streets:
+        n_streets += 1
+        if merge_duplicates:
+            collapsed += graph.merge_edge(start_point, end_point, priority, lanes, merge_policy)
+        else:
+            graph.add_edge(start_point, end_point, priority, lanes)
+
+    if collapsed:
+        logger.info("Merged %d duplicate street(s) of %d", collapsed, n_streets)
+    if report is not None:
+        report.update({"streets": n_streets, "collapsed": collapsed, "edges": len(graph.edges)})
+
+
+def osm_cache_key(center_point, dist, dist_type, network_type, custom_filter, snap_tolerance, merge_policy=None):
+    """
+    Content address of an OSM query - hash of all parameters that influence the resulting graph.
+    """
+    query = {
+        "version": OSM_CACHE_VERSION,
+        "center_point": [float(coordinate) for coordinate in center_point],
+        "dist": dist,
+        "dist_type": dist_type,
+        "network_type": network_type,
+        "custom_filter": custom_filter,
+        "snap_tolerance": snap_tolerance,
+        "merge_policy": {attribute: getattr(merge, "__name__", repr(merge))
+                         for attribute, merge in merge_policy.items()} if merge_policy else None,
+    }
+    return hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()
+
+
+def load_cached_graph(cache_key, cache_dir=None):
+    """
+    Returns the cached graph or None if there is no (readable) cache entry.
+    """
+    path = os.path.join(cache_dir or OSM_CACHE_DIR, cache_key)
+    if not is_saved_graph(path):
+        return None
+    try:
+        return load_graph(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Ignoring unreadable OSM cache entry '%s': %s", path, e)
+        return None
+
+
+def save_cached_graph(graph, cache_key, cache_dir=None):
+    """
+    Stores the graph in the cache (binary format of graph_store, written atomically).
+    """
+    path = os.path.join(cache_dir or OSM_CACHE_DIR, cache_key)
+    try:
+        save_graph(graph, path)
+    except OSError as e:
+        logger.warning("Could not write OSM cache entry '%s': %s", path, e)
+
+
+# Text street layouts (e.g. 'street_layout.txt') have one street per line in the following format:
+# (x1,y1) (x2,y2) priority lanes
+# The start point of the first street is the base.
+
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_LAYOUT_LINE = re.compile(rf"\(\s*({_NUMBER})\s*,\s*({_NUMBER})\s*\)\s+\(\s*({_NUMBER})\s*,\s*({_NUMBER})\s*\)"
+                          rf"\s+([-+]?\d+)\s+([-+]?\d+)")
+MAX_REPORTED_ERRORS = 10  # Number of invalid lines quoted in the warning (all of them are counted)
+
 
-def load_graph_from_file(filename):
-    graph = Graph(true_location=False)  # Create an empty graph
+def _parse_number(token):
+    # Integer coordinates stay integers (as in the layout files written by hand)
+    if "." in token or "e" in token or "E" in token:
+        return float(token)
+    return int(token)
+
+
+def parse_layout_lines(lines):
+    """
+    Parses lines of a text street layout without evaluating them.
 
+    Yields: (line_number, street, error) for every non-empty line - street is a tuple
+    ((x1, y1), (x2, y2), priority, lanes) and error None, or street None and error a description of the problem.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        match = _LAYOUT_LINE.fullmatch(line)
+        if match is None:
+            yield line_number, None, f"expected '(x1,y1) (x2,y2) priority lanes', got '{line}'"
+            continue
+        x1, y1, x2, y2, priority, lanes = match.groups()
+        yield line_number, ((_parse_number(x1), _parse_number(y1)), (_parse_number(x2), _parse_number(y2)),
+                            int(priority), int(lanes)), None
+
+
+def load_graph_from_file(filename, errors=None, strict=False, merge_duplicates=True, merge_policy=None, report=None):
+    """
+    Loads a text street layout (read line by line). Invalid lines are skipped and reported together
+    in one warning with their line numbers.
+
+    :param errors: list to which (line_number, description) of every invalid line is appended
+    :param strict: raise ValueError instead of skipping invalid lines
+    :param merge_duplicates, merge_policy, report: see add_streets
+    :return: 'Graph' object
+    """
+    streets = []
+    invalid_lines = []
     with open(filename, 'r') as file:
-        lines = file.readlines()  # Read all lines from the file
-
-        # Check if the line is not empty
-        lines = [line.strip() for line in lines if line.strip()]
-
-        # Treat the first point as the base
-        first_line = lines[0]
-        start_point, end_point, priority, lanes = first_line.split(" ")
-        start_point = eval(start_point)  # Convert e.g., "(0, 0)" to a tuple (0, 0)
-        end_point = eval(end_point)
-        priority = int(priority)
-        lanes = int(lanes)
-
-        graph.add_edge(start_point, end_point, priority, lanes)
-        graph.add_base(*start_point)  # Add the base
-
-        # Process the remaining lines - load the rest of the streets
-        for line in lines[1:]:
-            try:
-                start_point, end_point, priority, lanes = line.split(" ")
-                start_point = eval(start_point)
-                end_point = eval(end_point)
-                priority = int(priority)
-                lanes = int(lanes)
-
-                graph.add_edge(start_point, end_point, priority, lanes)
-            except ValueError as e:
-                print(f"Invalid format in line: '{line}'. Error: {e}")
-                continue  # Ignore the invalid line
+        for line_number, street, error in parse_layout_lines(file):
+            if error is None:
+                streets.append(street)
+            else:
+                invalid_lines.append((line_number, error))
+
+    if invalid_lines:
+        summary = "; ".join(f"line {line_number}: {error}"
+                            for line_number, error in invalid_lines[:MAX_REPORTED_ERRORS])
+        if len(invalid_lines) > MAX_REPORTED_ERRORS:
+            summary += f"; ... ({len(invalid_lines) - MAX_REPORTED_ERRORS} more)"
+        if strict:
+            raise ValueError(f"{len(invalid_lines)} invalid line(s) in '{filename}': {summary}")
+        logger.warning("Skipped %d invalid line(s) in '%s': %s", len(invalid_lines), filename, summary)
+        if errors is not None:
+            errors.extend(invalid_lines)
+    if not streets:
+        raise ValueError(f"No valid streets in '{filename}'")
+
+    # Only new objects are created - garbage collections triggered by them would find nothing to free
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        graph = Graph(true_location=False)  # Create an empty graph
+        add_streets(graph, streets, merge_duplicates, merge_policy, report)
+        graph.add_base(*streets[0][0])  # Treat the first point as the base
+    finally:
+        if gc_enabled:
+            gc.enable()
 
     return graph  # Return the completed graph
 
@@ -0,0 +1,82 @@
+"""
+Move records returned by the neighborhood functions.
+
+Instead of copying all machines before every modification, a neighborhood function builds the new route
+of one machine, and the difference between the old and the new route is stored as a RouteMove.
+The move is applied in place and can be reverted in place if the annealing rejects the new solution.
+
+Stages are stored the same way as in Machine.route_ids - as arrays of edge IDs. Stage arrays are never
+modified in place, a move replaces whole arrays.
+"""
+
+from array import array
+
+
+class RouteMove:
+    """
+    Change of the route of one machine: stages from first_stage on, old_stages are replaced by new_stages.
+    """
+
+    def __init__(self, machine, first_stage, old_stages, new_stages):
+        self.machine = machine
+        self.first_stage = first_stage
+        self.old_stages = old_stages  # List of stages (arrays of edge IDs) before the move
+        self.new_stages = new_stages  # List of stages (arrays of edge IDs) after the move
+        self.old_times = None  # Travel times of the stages, known after the first apply
+        self.new_times = None
+
+    def apply(self):
+        self.old_times, self.new_times = self.machine.replace_stages(
+            self.first_stage, len(self.old_stages), self.new_stages, self.new_times)
+
+    def revert(self):
+        self.machine.replace_stages(self.first_stage, len(self.new_stages), self.old_stages, self.old_times)
+
+    def __repr__(self):
+        return (f"RouteMove(stages {self.first_stage}-{self.first_stage + len(self.new_stages) - 1}, "
+                f"{sum(len(stage) for stage in self.old_stages)} -> {sum(len(stage) for stage in self.new_stages)} edges)")
+
+
+def apply_route(machine, new_route):
+    """
+    Replaces the route of the machine with new_route by applying only the stages that changed.
+    Stages of new_route are lists of edges or arrays of edge IDs (e.g. stages of machine.route_ids kept as they are).
+    :return: applied RouteMove or None if the route did not change.
+    """
+    old_route = machine.route_ids
+    new_route = [stage if isinstance(stage, array) else array('i', [edge.id for edge in stage])
+                 for stage in new_route]
+
+    first = 0
+    while first < min(len(old_route), len(new_route)) and (old_route[first] is new_route[first]
+                                                            or old_route[first] == new_route[first]):
+        first += 1
+
+    if first == len(old_route) == len(new_route):
+        return None  # No change
+
+    end_old, end_new = len(old_route), len(new_route)
+    while end_old > first and end_new > first and (old_route[end_old - 1] is new_route[end_new - 1]
+                                                   or old_route[end_old - 1] == new_route[end_new - 1]):
+        end_old -= 1
+        end_new -= 1
+
+    move = RouteMove(machine, first, old_route[first:end_old], new_route[first:end_new])
+    move.apply()
+    return move
+
+
+def snapshot_routes(machines):
+    """
+    Returns a lightweight copy of the solution - edge IDs for every machine and stage.
+    """
+    return [list(machine.route_ids) for machine in machines]
+
+
+def restore_routes(machines, snapshot):
+    """
+    Sets the routes of the machines from a snapshot created by snapshot_routes (the stage times of the machines
+    are recomputed on their next use).
+    """
+    for machine, route_ids in zip(machines, snapshot):
+        machine.route_ids = list(route_ids)
@@ -2,12 +2,23 @@
 Definition of two neighborhood functions ->
 
 - The 'current_solution' parameter is in the form [Machine_object, Machine_object...]
-- The returned solution is in the form [[path_1, path_2...], [] ...] - a route for one randomly selected machine
+- The route of one randomly selected machine is modified in place; the functions return the applied RouteMove
+  (or None if nothing changed), which can be reverted
 """
 
+import logging
 import random
+from array import array
+from moves import apply_route
+from bypass_finder import BypassFinder
+from route_timing import split_into_stages
 
-def neighbor_function_1(current_solution, search_depth, graph, T_max):
+logger = logging.getLogger(__name__)
+
+__all__ = ["neighbor_function_1", "neighbor_function_2", "complete_stage"]
+
+
+def neighbor_function_1(current_solution, search_depth, graph, T_max, bypass_finder=None):
     """
     Function randomly selects a machine whose route will be modified.
     Then, by randomly selecting a path from the route, it tries to find a new route that avoids one vertex.
@@ -21,20 +32,25 @@ def neighbor_function_1(current_solution, search_depth, graph, T_max):
 
     Best results for modifying the last stage; for others, there is a high probability of route repetition,
     especially with a large value of the 'search_depth' parameter.
+
+    'bypass_finder' (BypassFinder of the graph) keeps its index and failed searches between calls,
+    if None, a new one is used.
     """
+    if bypass_finder is None or bypass_finder.graph is not graph:
+        bypass_finder = BypassFinder(graph)
 
     # Randomly select one machine
     machine_id = random.randint(0, len(current_solution) - 1)
     machine = current_solution[machine_id]
     machine_speed = machine.speed
-    machine_routes = [m.route for m in current_solution]
-    initial_machine_routes = machine_routes
-    route = machine.route
+    edges = graph.edges
 
     # Solution in the form of [[]], where sublists are for different stages (for one machine)
-    num_stages = len(route)  # Remember the number of stages
-    # Combine sublists into one list
-    route_list = [edge for sublist in route for edge in sublist]
+    num_stages = len(machine.route_ids)  # Remember the number of stages
+    # Combine the stages into one array of edge IDs
+    route_list = array('i')
+    for stage_ids in machine.route_ids:
+        route_list.extend(stage_ids)
 
     id1 = random.randint(0, len(route_list) - 2)  # Randomly select an edge
     id2 = id1 + 1
@@ -50,47 +66,16 @@ def neighbor_function_1(current_solution, search_depth, graph, T_max):
     new_route = []  # New route bypassing one vertex
 
     while change:
-        random_edge = route_list[id1]
-        next_edge = route_list[id2]
+        random_edge = edges[route_list[id1]]
+        next_edge = edges[route_list[id2]]
 
         max_depth = search_depth
         start = random_edge.start
         goal = next_edge.end
         avoid = random_edge.end
 
-        # Function that finds a new route bypassing a given vertex
-        # max_depth - parameter that determines how deep the function can search for a new route
-        # Returns a list of edges (new route) or an empty list ([]) if no route is found
-        def find_new_route(start, goal, max_depth, avoid):
-            visited = []  # List of visited vertices
-            visited.append(avoid)  # Add the vertex to be avoided
-            stack = [(start, 0, [])]  # Tuple (vertex, depth, list of edges)
-
-            while stack:
-                current_vertex, depth, path = stack.pop()
-
-                if depth > max_depth:
-                    continue
-                if current_vertex == goal:
-                    return path  # Return the list of edges forming the path
-                if current_vertex in visited:
-                    continue
-
-                visited.append(current_vertex)
-
-                # Add neighbors to the stack
-                for neighbor in current_vertex.neighbors:
-                    if neighbor not in visited:
-                        # Find the edge connecting `current` and `neighbor`
-                        edge = graph.get_edge(current_vertex, neighbor)
-                        if edge:
-                            # Create a new list of edges (path + edge)
-                            new_path = path + [edge]
-                            stack.append((neighbor, depth + 1, new_path))
-
-            return []  # If no route is found, return an empty list
-
-        new_route = find_new_route(start, goal, max_depth, avoid)
+        # New route bypassing the vertex `avoid` - list of edges or [] if none is found within max_depth edges
+        new_route = bypass_finder.find(start, goal, max_depth, avoid)
 
         # Move to the next path in the stage to find another bypass
         if new_route == []:
@@ -109,32 +94,15 @@ def neighbor_function_1(current_solution, search_depth, graph, T_max):
             break
 
     if route_change:
-        new_solution = route_list[0:id1] + new_route + route_list[id2+1:]
+        new_solution = ([edges[edge_id] for edge_id in route_list[0:id1]] + new_route
+                        + [edges[edge_id] for edge_id in route_list[id2+1:]])
 
         # Now divide the entire list into the initial number of stages with the appropriate maximum time
-        solution_list = [[] for _ in range(num_stages)]
-        stage = 0
-        time_cost = 0
-
-        for edge in new_solution:
-            edge_cost = edge.calculate_length() / machine_speed
-
-            if time_cost + edge_cost > T_max:
-                stage += 1
-                time_cost = 0
-
-                if stage > (num_stages - 1):
-                    break
-                else:
-                    solution_list[stage].append(edge)
-                    time_cost += edge_cost
-
-            else:
-                solution_list[stage].append(edge)
-                time_cost += edge_cost
+        solution_list, stage, stage_times = split_into_stages(new_solution, machine_speed, T_max, num_stages)
 
         if stage < len(solution_list):
-            complete_stage(solution_list, stage, graph, T_max, machine_speed, param2=0)
+            complete_stage(solution_list, stage, graph, T_max, machine_speed, param2=0,
+                           current_time=stage_times[stage])
         stage += 1
 
         while stage < num_stages:
@@ -142,14 +110,11 @@ def neighbor_function_1(current_solution, search_depth, graph, T_max):
                 complete_stage(solution_list, stage, graph, T_max, machine_speed, param2=0)
             stage += 1
 
-        machine.route = solution_list
-        machine_routes[machine_id] = solution_list
-
-        return machine_routes
+        return apply_route(machine, solution_list)
 
     else:
-        print("No change!")
-        return initial_machine_routes
+        logger.debug("No change!")
+        return None
 
 
 def neighbor_function_2(current_solution, graph, T_max, param2=2):
@@ -170,29 +135,28 @@ def neighbor_function_2(current_solution, graph, T_max, param2=2):
     machine_id = random.randint(0, len(current_solution) - 1)
     machine = current_solution[machine_id]
     machine_speed = machine.speed
-    machine_routes = [m.route for m in current_solution]
-    route = machine.route
+    route_ids = machine.route_ids  # Stages before the selected one are kept as they are, only the rest is read
 
     # Solution in the form of [[]], where sublists are for different stages (for one machine)
-    num_stages = len(route)  # Remember the number of stages
+    num_stages = len(route_ids)  # Remember the number of stages
     if num_stages <= 1:
-        return route
+        return None
     stage = random.randint(1, num_stages - 1)  # Randomly select a stage (excluding the initial one)
 
-    stages_to_modify = [idx for idx in range(1, num_stages) if len(route[idx]) > 0]
+    stages_to_modify = [idx for idx in range(1, num_stages) if len(route_ids[idx]) > 0]
     if not stages_to_modify:
-        print("No non-empty stage (except the first one) - no change!")
-        return route
+        logger.debug("No non-empty stage (except the first one) - no change!")
+        return None
 
     stage = random.choice(stages_to_modify)
 
-    new_solution = route[:stage]  # Preserve stages up to the selected one in unchanged form
-    start = route[stage][0].start
+    new_solution = route_ids[:stage]  # Preserve stages up to the selected one in unchanged form
+    start = graph.edges[route_ids[stage][0]].start
 
     # Set of edges from the previous stage
     prev_stage = stage - 1
     visited_edges = set()
-    for edge in route[prev_stage]:
+    for edge in machine.stage_edges(prev_stage):
         visited_edges.add(edge.start)
         visited_edges.add(edge.end)
 
@@ -223,32 +187,33 @@ def neighbor_function_2(current_solution, graph, T_max, param2=2):
                     break
 
             # Check if we exceed the maximum time
-            if time_cost + chosen_edge.calculate_length() / machine_speed >= T_max:
+            if time_cost + chosen_edge.length / machine_speed >= T_max:
                 break
 
             else:
                 # Add the chosen edge to the route and update the time
                 new_route.append(chosen_edge)
-                time_cost += chosen_edge.calculate_length() / machine_speed
+                time_cost += chosen_edge.length / machine_speed
                 start = chosen_edge.end  # Update the current vertex
 
         if len(new_route) == 0:
             # If nothing was added in the entire while loop,
             # revert the modifications or try another method
-            print("Stage turned out to be empty even with fallback - abandoning modification.")
-            return route
+            logger.debug("Stage turned out to be empty even with fallback - abandoning modification.")
+            return None
 
         # Add the new route to the stage
         new_solution.append(new_route)
 
         visited_edges = set()
-        for edge in route[stage_id]:
+        for edge in machine.stage_edges(stage_id):
             visited_edges.add(edge.start)
             visited_edges.add(edge.end)
 
     if len(new_solution) > 0:  # Check if we have any stages
         if stage < len(new_solution):
-            complete_stage(new_solution, stage_id, graph, T_max, machine_speed, param2=0)
+            # time_cost -> travel time of the last built stage
+            complete_stage(new_solution, stage_id, graph, T_max, machine_speed, param2=0, current_time=time_cost)
         stage_id += 1
 
         while stage_id < num_stages:
@@ -256,16 +221,14 @@ def neighbor_function_2(current_solution, graph, T_max, param2=2):
                 complete_stage(new_solution, stage_id, graph, T_max, machine_speed, param2=0)
             stage_id += 1
 
-    machine.route = new_solution
-    machine_routes[machine_id] = new_solution
-
-    return machine_routes
+    return apply_route(machine, new_solution)
 
 
-def complete_stage(solution_list, stage_index, graph, T_max, speed, param2=2):
+def complete_stage(solution_list, stage_index, graph, T_max, speed, param2=2, current_time=None):
     """
     Attempts to 'complete' the last stage (solution_list[stage_index]),
     if there is still time < T_max.
+    'current_time' - travel time of the stage if the caller already knows it (otherwise it is summed here).
     Returns: nothing - directly modifies solution_list[stage_index].
     """
 
@@ -287,9 +250,10 @@ def complete_stage(solution_list, stage_index, graph, T_max, speed, param2=2):
         start_vertex = solution_list[stage_index][-1].end
 
     # Calculate the current time in the stage
-    current_time = 0
-    for edge in solution_list[stage_index]:
-        current_time += edge.calculate_length() / speed
+    if current_time is None:
+        current_time = 0
+        for edge in solution_list[stage_index]:
+            current_time += edge.length / speed
 
     # While there is time, try to add edges
     while True:
@@ -312,7 +276,7 @@ def complete_stage(solution_list, stage_index, graph, T_max, speed, param2=2):
                 if edge.end in recent_vertices:
                     continue
 
-            cost = edge.calculate_length() / speed
+            cost = edge.length / speed
             if current_time + cost <= T_max:
                 chosen_edge = edge
                 break
@@ -323,5 +287,5 @@ def complete_stage(solution_list, stage_index, graph, T_max, speed, param2=2):
 
         # Add the edge
         solution_list[stage_index].append(chosen_edge)
-        current_time += chosen_edge.calculate_length() / speed
+        current_time += chosen_edge.length / speed
         start_vertex = chosen_edge.end
\ No newline at end of file
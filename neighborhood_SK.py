@@ -1,47 +1,86 @@
 import heapq
+import itertools
+import logging
+import math
 import random
-import copy
+from array import array
+from moves import apply_route
+from street_usage import StreetUsage
+from detour_cache import repair_path_A_star
+from route_timing import resegment_route
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["find_path_to_edge", "shortest_path_to_edge", "fill_remaining_time", "generate_route_from_least_frequent",
+           "adjust_route_to_tmax", "change_path", "squish_routes"]
 
 
 def find_path_to_edge(road_layout, target_edge, machine_speed):
     """
     Find path from base to the start of target edge using A* algorithm.
     Returns path and total time cost.
+
+    The heap holds (f, counter, vertex) - the counter breaks ties in insertion order, so vertices are never
+    compared. The path is rebuilt from parent edges once the target is reached.
     """
-    open_set = [(0, road_layout.baza, [])]
-    closed_set = set()
+    start = road_layout.baza
+    target = target_edge.start
 
-    # Target nodes are both start and end of the target edge
+    g_score = {start: 0}
+    parent_edge = {start: None}  # Vertex -> edge through which it was reached with the best known g
+    counter = itertools.count()
+    open_set = [(0, next(counter), start)]
+    closed_set = set()
 
     while open_set:
-        f_score, current, path = heapq.heappop(open_set)
-
-        if current == target_edge.start:
-            total_time = sum(edge.calculate_length() for edge in path) / machine_speed
+        f_score, _, current = heapq.heappop(open_set)
+
+        if current == target:
+            path = []
+            edge = parent_edge[current]
+            while edge is not None:
+                path.append(edge)
+                edge = parent_edge[edge.start]
+            path.reverse()
+            total_time = sum(edge.length for edge in path) / machine_speed
             return path, total_time, current
 
         if current in closed_set:
             continue
 
         closed_set.add(current)
+        current_g = g_score[current]
 
         for neighbor in current.neighbors:
             if neighbor in closed_set:
                 continue
 
             edge = road_layout.get_edge(current, neighbor)
+            tentative_g = current_g + edge.length
+            if tentative_g >= g_score.get(neighbor, math.inf):
+                continue
 
-            new_path = path + [edge]
-            g_score = sum(e.calculate_length() for e in new_path)
-            # Use minimum distance to either end of target edge as heuristic
-            h_score = neighbor.get_distance(target_edge.start) # road_layout.get_edge(neighbor, target_edge.start).dlugosc
-            f_score = g_score + h_score
-
-            heapq.heappush(open_set, (f_score, neighbor, new_path))
+            g_score[neighbor] = tentative_g
+            parent_edge[neighbor] = edge
+            # Use distance to the start of target edge as heuristic
+            f_score = tentative_g + neighbor.get_distance(target)
+            heapq.heappush(open_set, (f_score, next(counter), neighbor))
 
     return None, 0, None
 
 
+def shortest_path_to_edge(road_layout, target_edge, machine_speed):
+    """
+    Same result as find_path_to_edge, but the path is reconstructed from the shortest path tree of the base,
+    which the graph computes once and caches until it is modified (Graph.shortest_path_tree).
+    Returns path and total time cost.
+    """
+    path = road_layout.shortest_path(road_layout.baza, target_edge.start)
+    if path is None:
+        return None, 0, None
+    return path, sum(edge.length for edge in path) / machine_speed, target_edge.start
+
+
 def fill_remaining_time(road_layout, start_node, remaining_time, machine_speed):
     """
     Fill remaining time with additional edges using a greedy approach.
@@ -67,7 +106,7 @@ def fill_remaining_time(road_layout, start_node, remaining_time, machine_speed):
         edge = road_layout.get_edge(current_node, next_node)
 
         # Check if adding this edge would exceed remaining time
-        time_cost = edge.calculate_length() / machine_speed
+        time_cost = edge.length / machine_speed
         if time_used + time_cost > remaining_time:
             break
 
@@ -81,120 +120,114 @@ def fill_remaining_time(road_layout, start_node, remaining_time, machine_speed):
     return additional_route, time_used
 
 
-def generate_route_from_least_frequent(machines, road_layout, Tmax, consider_priority=False):
+def generate_route_from_least_frequent(machines, road_layout, Tmax, consider_priority=False, street_usage=None):
     """
     Generuje trasęz bazy do najmniej uczęszczanej ulicy i
     ewentualnie dokłada ulice na koniec trasy, aby wypełnić czas.
+
+    street_usage -> StreetUsage of these machines kept between calls (only changed stages are recounted),
+    None -> counted from scratch.
     """
 
     current_machine = random.choice(machines)
-    num_of_stages = len(current_machine.route)
-
-    def calculate_street_frequency(edge):
-        frequency = 0
-        for machine in machines:
-            if machine != current_machine:  # Don't count current machine
-                for stage_index in range(num_of_stages):
-                    frequency += sum(1 for route_edge in machine.route[stage_index]
-                                     if route_edge == edge)
-
-        # If considering priority, adjust frequency score by priority
-        if consider_priority:
+    num_of_stages = len(current_machine.route_ids)
+    machine_index = next(i for i, machine in enumerate(machines) if machine is current_machine)
+
+    # Number of times every street (street ID) is cleared by the other machines
+    if street_usage is None or street_usage.machines is not machines:
+        street_usage = StreetUsage(road_layout, machines)
+    street_usage.sync()
+
+    if consider_priority:
+        def calculate_street_frequency(edge):
             # Normalize frequency to 0-1 range and combine with priority
             # Lower frequency and higher priority will give lower score
+            frequency = street_usage.other_usage(machine_index, edge.street_id)
             freq_score = frequency / (len(machines) - 1) if len(machines) > 1 else 1
-            priority_score = 1 - (edge.priority / max(e.priority for e in road_layout.edges))
+            priority_score = 1 - (edge.priority / street_usage.max_priority)
             return (freq_score + priority_score) / 2
-        return frequency
-
-    # Calculate frequencies for all edges
-    edge_scores = [(calculate_street_frequency(edge), edge) for edge in road_layout.edges]
-    edge_scores.sort(key=lambda x: x[0])  # Sort by frequency/score
 
-    # Try edges starting from least frequent
-    for _, target_edge in edge_scores:
-        # Find path from base to target edge
-        path_to_edge, time_to_edge, reached_node = find_path_to_edge(
-            road_layout,
-            target_edge,
-            current_machine.speed
-        )
+        edge_scores = sorted(road_layout.edges, key=calculate_street_frequency)
+        candidates = (edge.id for edge in edge_scores)
+    else:
+        # Least used edges first, taken from the heap only as far as needed
+        candidates = street_usage.least_used_edges(machine_index)
 
-        # print(current_machine.route)
-        if path_to_edge is not None:
-            # Add the target edge to the path
-            route = path_to_edge + [target_edge]
+    try:
+        # Try edges starting from least frequent
+        for edge_id in candidates:
+            target_edge = road_layout.edges[edge_id]
+            route = _route_through_edge(current_machine, road_layout, target_edge, num_of_stages, Tmax)
+            if route is not None:
+                return apply_route(current_machine, route)
+    finally:
+        candidates.close()  # Returns the popped entries to the heap
 
-            # Calculate time cost of path for all stages including initial edge
-            time_cost = (sum(edge.calculate_length() for edge in route) / current_machine.speed)
+    # If no valid route found, the route is not changed
+    return None
 
-            if time_cost <= Tmax * num_of_stages:
-                # Try to fill remaining time
-                remaining_time = Tmax * num_of_stages - time_cost
-                if remaining_time > 0:
-                    additional_edges, additional_time = fill_remaining_time(
-                        road_layout,
-                        route[-1].end,
-                        remaining_time,
-                        current_machine.speed
-                    )
 
-                    route.extend(additional_edges)
+def _route_through_edge(current_machine, road_layout, target_edge, num_of_stages, Tmax):
+    """
+    Route of current_machine from the base through target_edge, filled up with greedy edges to use
+    the whole time, or None if target_edge cannot be reached in time.
+    """
+    # Find path from base to target edge
+    path_to_edge, time_to_edge, reached_node = shortest_path_to_edge(
+        road_layout,
+        target_edge,
+        current_machine.speed
+    )
 
-                # print(route)
-                route = [route] + [[] for _ in range(num_of_stages - 1)]
-                route = adjust_route_to_tmax(route, current_machine, Tmax)
-                # print(route)
-                current_machine.route = route
-                return route
+    if path_to_edge is None:
+        return None
 
-    # If no valid route found, return empty route
-    return []
+    # Add the target edge to the path
+    route = path_to_edge + [target_edge]
 
+    # Calculate time cost of path for all stages including initial edge
+    time_cost = (sum(edge.length for edge in route) / current_machine.speed)
 
-def adjust_route_to_tmax(new_route, machine, Tmax):
-    """
-    Dostosowuje trasę do maksymalnego czasu Tmax, przesuwając nadmiarowe krawędzie
-    do następnego segmentu lub usuwając je, jeśli to ostatni segment.
-    """
+    if time_cost > Tmax * num_of_stages:
+        return None
 
-    for segment_idx in range(len(new_route)):
-        while True:
-            time = 0
-            edges_to_move = []
+    # Try to fill remaining time
+    remaining_time = Tmax * num_of_stages - time_cost
+    if remaining_time > 0:
+        additional_edges, additional_time = fill_remaining_time(
+            road_layout,
+            route[-1].end,
+            remaining_time,
+            current_machine.speed
+        )
 
-            # Oblicz całkowity czas dla bieżącego segmentu
-            for edge_idx, edge in enumerate(new_route[segment_idx]):
-                time += edge.length / machine.speed
+        route.extend(additional_edges)
 
-                # Jeśli czas przekracza Tmax, przygotuj się do przesunięcia krawędzi
-                if time > Tmax:
-                    edges_to_move.append((edge_idx, edge))
+    route = [route] + [[] for _ in range(num_of_stages - 1)]
+    return adjust_route_to_tmax(route, current_machine, Tmax)
 
-            # Jeśli nie ma krawędzi do przesunięcia, zakończ pętlę
-            if not edges_to_move:
-                break
 
-            # Przesuń nadmiarowe krawędzie do kolejnego segmentu
-            if segment_idx < len(new_route) - 1:
-                for edge_idx, edge in reversed(edges_to_move):
-                    # Krawędź pod danym indeksem ustawiamy na None, aby uniknąć usunięcia z segmentu trasy
-                    # wszystkich wystąpień danej krawędzi
-                    new_route[segment_idx][edge_idx] = None
-                    new_route[segment_idx + 1].insert(0, edge)
+def adjust_route_to_tmax(new_route, machine, Tmax, unchanged_stages=()):
+    """
+    Dostosowuje trasę do maksymalnego czasu Tmax, przesuwając nadmiarowe krawędzie
+    do następnego segmentu lub usuwając je, jeśli to ostatni segment.
+    Jedno przejście po trasie z bieżącą sumą czasów przejazdu (route_timing.resegment_route).
 
-            else:
-                # Jeśli to ostatni segment, usuń nadmiarowe krawędzie
-                for edge_idx, edge in edges_to_move:
-                    new_route[segment_idx][edge_idx] = None
+    unchanged_stages -> indeksy etapów new_route równych bieżącym etapom maszyny; ich czas jest brany
+    z rejestru czasów etapów maszyny (Machine.stage_time) zamiast sumowania krawędzi. Etapy mogą być też
+    tablicami ID krawędzi (Machine.route_ids) - są zamieniane na krawędzie tylko, jeśli trzeba je przyciąć.
+    """
+    unchanged_stages = set(unchanged_stages)
 
-            # Usuwanie z segmentu wszystkich None'ów
-            new_route[segment_idx] = [edge for edge in new_route[segment_idx] if edge is not None]
+    def fits(stage_idx):
+        return stage_idx in unchanged_stages and machine.fits_in_stage(stage_idx, 0, Tmax)
 
+    new_route[:] = resegment_route(new_route, machine.speed, Tmax, fits if unchanged_stages else None,
+                                   machine.road_layout.edges)
     return new_route
 
 
-def change_path(machines, road_layout, Tmax):
+def change_path(machines, road_layout, Tmax, detour_cache=None):
     """
         Modyfikuje trasę maszyny, usuwając jedną krawędź i zastępując ją nową trasą naprawioną algorytmem A*.
         Przenosi krawędzie do następnego etapu, jeśli Tmax zostanie przekroczone.
@@ -203,90 +236,39 @@ def change_path(machines, road_layout, Tmax):
             machines (List[Machine]): Lista maszyn.
             road_layout (Graph): Graf reprezentujący układ drogowy.
             Tmax (float): Maksymalny czas na segment trasy.
+            detour_cache (DetourCache): Objazdy krawędzi zapamiętane między wywołaniami (None -> liczone od nowa).
 
         Returns:
-            list: Zaktualizowane trasy dla maszyn.
+            RouteMove: Zastosowana zmiana trasy lub None, jeśli trasa się nie zmieniła.
         """
 
-    def repair_path_A_star(removed_edge, graph):
-        open_set = []
-        heapq.heappush(open_set, (0, removed_edge.start))  # Kolejka priorytetowa
-        closed_set = set()  # Zbiór odwiedzonych węzłów
-        came_from = {}  # Przechowuje ścieżkę (z wierzchołka na wierzchołek)
-        g_score = {node: float('inf') for node in graph.vertices}  # Koszt dotarcia
-        g_score[removed_edge.start] = 0
-
-        while open_set:
-            _, current = heapq.heappop(open_set)
-
-            # Jeśli dotarliśmy do celu, rekonstruujemy ścieżkę
-            if current == removed_edge.end:
-                path = []
-                while current in came_from:
-                    prev_node = came_from[current]
-                    edge = graph.get_edge(prev_node, current)
-                    path.append(edge)
-                    current = prev_node
-                return path[::-1]  # Odwróć kolejność, by zaczynać od startu
-
-            # Dodaj węzeł do zbioru odwiedzonych
-            closed_set.add(current)
-
-            # Iterujemy po sąsiadach wierzchołka
-            for neighbor in current.neighbors:
-                edge = graph.get_edge(current, neighbor)
-
-                # Ignorujemy krawędź usuniętą
-                if edge == removed_edge:
-                    continue
-
-                # Ignorujemy węzły już odwiedzone
-                if neighbor in closed_set:
-                    continue
-
-                # Oblicz koszt przejścia
-                tentative_g_score = g_score[current] + current.get_distance(neighbor)
-                # graph.get_edge(current, neighbor).dlugosc
-
-                if tentative_g_score < g_score[neighbor]:
-                    came_from[neighbor] = current  # Zaktualizuj ścieżkę
-                    g_score[neighbor] = tentative_g_score
-                    f_score = tentative_g_score + neighbor.get_distance(removed_edge.end)
-                    # graph.get_edge(neighbor, removed_edge.koniec).dlugosc # Heurystyka (odległość do celu)
-                    heapq.heappush(open_set, (f_score, neighbor))
-
-            # print('dasdas')
-        return None  # Jeśli nie znaleziono ścieżki
-
     machine = random.choice(machines)
-    machine_copy = copy.deepcopy(machine)
-    new_route = machine_copy.route
+    new_route = list(machine.route_ids)  # Etapy jako tablice ID krawędzi - zmieniony etap jest zastępowany listą
 
     segment_idx = random.choice(range(len(new_route)))
 
-    # if len(new_route[segment_idx]) == 0:
-    #     return None
-    #
-    try:
-        edge_for_deletion_idx = random.choice(range(len(new_route[segment_idx])))
+    if len(new_route[segment_idx]) == 0:
+        return None  # Pusty etap - nie ma krawędzi do usunięcia, trasa się nie zmienia
 
-    except IndexError:
-        print(new_route[segment_idx])
+    edge_for_deletion_idx = random.choice(range(len(new_route[segment_idx])))
 
-    edge_for_deletion = new_route[segment_idx][edge_for_deletion_idx]
+    stage = machine.stage_edges(segment_idx)
+    edge_for_deletion = stage[edge_for_deletion_idx]
 
-    repaired_path = repair_path_A_star(edge_for_deletion, road_layout)
-    # print(repaired_path)
+    if detour_cache is not None:
+        repaired_path = detour_cache.get(edge_for_deletion)
+    else:
+        repaired_path = repair_path_A_star(edge_for_deletion, road_layout)
 
     if repaired_path is not None:
         # Replace the deleted edge with the repaired path
-        new_route[segment_idx][edge_for_deletion_idx:edge_for_deletion_idx + 1] = repaired_path
-        new_route = adjust_route_to_tmax(new_route, machine, Tmax)
-        # print(new_route)
+        stage[edge_for_deletion_idx:edge_for_deletion_idx + 1] = repaired_path
+        new_route[segment_idx] = stage
+        unchanged_stages = [idx for idx in range(len(new_route)) if idx != segment_idx]
+        new_route = adjust_route_to_tmax(new_route, machine, Tmax, unchanged_stages)
+        return apply_route(machine, new_route)
 
-    machine.route = new_route
-
-    return [machine.route for machine in machines]
+    return None
 
 
 # ---------- JESZCZE NIE DZIAŁA -------------- #
@@ -303,23 +285,23 @@ def squish_routes(machines, road_layout, Tmax):
     """
 
     for machine in machines:
-        route = machine.route
-        for stage_idx in range(1, len(machine.route) - 1):
-            stage_time = 0
-            for edge in route[stage_idx]:
-                stage_time += edge.length / machine.speed
+        route = list(machine.route_ids)  # Etapy jako tablice ID krawędzi, zastępowane nowymi tablicami
+        edges = road_layout.edges
+        edge_times = machine.edge_times()
+        for stage_idx in range(1, len(route) - 1):
+            stage_time = machine.stage_time(stage_idx) if route[stage_idx] is machine.route_ids[stage_idx] \
+                else sum(edge_times[edge_id] for edge_id in route[stage_idx])
 
             next_stage_first_edge = route[stage_idx + 1][0]
 
-            if stage_time + next_stage_first_edge.length / machine.speed < Tmax:
-                route[stage_idx].append(route[stage_idx + 1].pop(0))
-                print('lista ściśnięta')
+            if stage_time + edge_times[next_stage_first_edge] < Tmax:
+                route[stage_idx] = route[stage_idx] + route[stage_idx + 1][:1]
+                route[stage_idx + 1] = route[stage_idx + 1][1:]
+                logger.debug('lista ściśnięta')
 
         # Próbujemy dodać dodatkowe krawędzie do ostatniego etapu
-        last_stage_time = 0
-        last_node = [edge for stage in route for edge in stage][-1].end
-        for edge in route[-1]:
-            last_stage_time += edge.length / machine.speed
+        last_node = edges[next(stage[-1] for stage in reversed(route) if stage)].end
+        last_stage_time = sum(edge_times[edge_id] for edge_id in route[-1])
 
         possible_edges = []
         for neighbor in last_node.neighbors:
@@ -328,6 +310,7 @@ def squish_routes(machines, road_layout, Tmax):
         possible_edges.sort(key=lambda x: x.length)
         possible_edges = [edge for edge in possible_edges if edge.snow_level != 0]
 
+        last_stage = list(route[-1])
         while possible_edges:
             shortest_edge = possible_edges.pop(0)
             last_stage_time += shortest_edge.length / machine.speed
@@ -335,7 +318,11 @@ def squish_routes(machines, road_layout, Tmax):
             if last_stage_time > Tmax:
                 break
 
-            machine.route[-1].append(shortest_edge)
-            print('dodano element')
+            last_stage.append(shortest_edge.id)
+            logger.debug('dodano element')
+
+        if len(last_stage) > len(route[-1]):
+            route[-1] = array('i', last_stage)
+        apply_route(machine, route)
 
     return [machine.route for machine in machines]
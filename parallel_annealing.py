@@ -0,0 +1,210 @@
+"""
+Running several annealing chains in worker processes.
+
+multi_start_annealing -> N independent chains with different seeds (different random initial routes),
+                         the best of them is returned together with diagnostics of every chain.
+parallel_tempering -> K replicas at a ladder of constant temperatures; after every round of Metropolis steps
+                      states of neighboring temperatures are swapped according to the Metropolis criterion.
+
+Workers receive the road layout pickled in the flat form produced by Graph.__getstate__, so edge IDs are the same
+in every process and the routes are sent back as arrays of edge IDs. If the layout was saved with
+graph_store.save_graph, graph_file passes only its path - every worker memory-maps the same arrays instead of
+unpickling its own copy.
+"""
+
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from graph_store import load_graph
+from moves import restore_routes
+from solution import RoadClearingProblem, Machine
+
+_worker_problem = None  # RoadClearingProblem of a parallel tempering worker process, created once per process
+
+
+def _worker_layout(road_layout):
+    # Path of a layout saved by graph_store.save_graph or the Graph itself
+    if isinstance(road_layout, (str, os.PathLike)):
+        return load_graph(road_layout)
+    return road_layout
+
+
+def _run_chain(seed, snowfall_forecast, road_layout, speeds, Tmax, danger_backend, annealing_params):
+    random.seed(seed)
+    start_time = time.perf_counter()
+
+    machines = [Machine(speed=speed) for speed in speeds]
+    problem = RoadClearingProblem(snowfall_forecast, _worker_layout(road_layout), machines, Tmax,
+                                  danger_backend=danger_backend)
+    best_solution, best_danger, diagnostics = problem.simulated_annealing(**annealing_params)
+
+    return {
+        "seed": seed,
+        "best_danger": best_danger,
+        "route_ids": [machine.route_ids for machine in best_solution],
+        "diagnostics": diagnostics,
+        "time": time.perf_counter() - start_time,
+    }
+
+
+def multi_start_annealing(problem, n_chains=None, max_workers=None, seed=None, graph_file=None, **annealing_params):
+    """
+    Runs n_chains independent simulated annealing chains in a process pool and keeps the best solution.
+
+    :param problem: RoadClearingProblem - source of the road layout, forecast, machine speeds and Tmax
+    :param n_chains: number of chains, default - number of CPU cores
+    :param max_workers: number of worker processes, default - number of CPU cores
+    :param seed: seed of the first chain (chain i uses seed + i), None -> random seeds
+    :param graph_file: directory with problem.road_layout saved by graph_store.save_graph, loaded by the workers
+                       instead of receiving the pickled layout
+    :param annealing_params: parameters of RoadClearingProblem.simulated_annealing
+    :return: best_solution, best_danger, chains -> list of dictionaries (seed, best_danger, diagnostics, time),
+             one per chain, in the order of seeds
+    """
+    n_chains = n_chains or os.cpu_count() or 1
+    if seed is None:
+        seeds = [random.randrange(2 ** 32) for _ in range(n_chains)]
+    else:
+        seeds = [seed + i for i in range(n_chains)]
+
+    speeds = [machine.speed for machine in problem.machines]
+    road_layout = graph_file if graph_file is not None else problem.road_layout
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_run_chain, chain_seed, problem.snowfall_forecast, road_layout, speeds,
+                                   problem.Tmax, problem.danger_backend, annealing_params)
+                   for chain_seed in seeds]
+        chains = [future.result() for future in futures]
+
+    best_chain = min(chains, key=lambda chain: chain["best_danger"])
+    restore_routes(problem.machines, best_chain["route_ids"])
+
+    for chain in chains:
+        del chain["route_ids"]
+
+    return problem.machines, best_chain["best_danger"], chains
+
+
+def _init_tempering_worker(snowfall_forecast, road_layout, speeds, Tmax, danger_backend):
+    global _worker_problem
+    machines = [Machine(speed=speed) for speed in speeds]
+    _worker_problem = RoadClearingProblem(snowfall_forecast, _worker_layout(road_layout), machines, Tmax,
+                                          danger_backend=danger_backend)
+
+
+def _run_replica(route_ids, temperature, steps, choose_neighbour_function, seed):
+    random.seed(seed)
+    problem = _worker_problem
+    if route_ids is None:
+        problem.get_initial_path()
+    else:
+        restore_routes(problem.machines, route_ids)
+
+    current_danger, best_solution, best_danger, accepted = problem.sample_at_temperature(
+        temperature, steps, choose_neighbour_function)
+
+    return {
+        "route_ids": [machine.route_ids for machine in problem.machines],
+        "danger": current_danger,
+        "best_route_ids": best_solution,
+        "best_danger": best_danger,
+        "accepted": accepted,
+    }
+
+
+def temperature_ladder(t_min, t_max, n_replicas):
+    """
+    Returns n_replicas temperatures spaced geometrically from t_max down to t_min.
+    """
+    if n_replicas == 1:
+        return [t_max]
+    return [t_max * (t_min / t_max) ** (k / (n_replicas - 1)) for k in range(n_replicas)]
+
+
+def parallel_tempering(problem, temperatures=None, n_replicas=None, t_min=0.01, t_max=100, n_rounds=100,
+                       steps_per_round=50, choose_neighbour_function=None, max_workers=None, seed=None,
+                       graph_file=None):
+    """
+    Replica exchange variant of the simulated annealing.
+
+    Every replica runs steps_per_round Metropolis steps at its own constant temperature (in a worker process),
+    then neighboring temperatures try to swap their states, alternating the even and odd pairs every round.
+    A swap between temperatures T_i and T_j with dangers E_i, E_j is accepted with probability
+    min(1, exp((E_i - E_j) * (1 / T_i - 1 / T_j))).
+
+    :param problem: RoadClearingProblem - source of the road layout, forecast, machine speeds and Tmax
+    :param temperatures: explicit temperature ladder, otherwise n_replicas temperatures from t_max to t_min
+    :param n_replicas: number of replicas, default - number of CPU cores
+    :param seed: seed of the random generator used for initial states, steps and swaps
+    :param graph_file: directory with problem.road_layout saved by graph_store.save_graph (see multi_start_annealing)
+    :return: best_solution, best_danger, diagnostics -> dictionary:
+             temperatures, swap_attempts, swap_accepted and swap_acceptance (per pair of neighboring temperatures),
+             move_acceptance (per temperature), danger_history (danger of every temperature after each round),
+             best_danger_history
+    """
+    if temperatures is None:
+        temperatures = temperature_ladder(t_min, t_max, n_replicas or os.cpu_count() or 1)
+    temperatures = list(temperatures)
+    n_replicas = len(temperatures)
+    rng = random.Random(seed)
+
+    states = [None] * n_replicas  # State at every temperature - route_ids of the machines
+    dangers = [None] * n_replicas
+    best_solution, best_danger = None, float("inf")
+
+    swap_attempts = [0] * (n_replicas - 1)
+    swap_accepted = [0] * (n_replicas - 1)
+    moves_accepted = [0] * n_replicas
+    danger_history = []
+    best_danger_history = []
+
+    speeds = [machine.speed for machine in problem.machines]
+    with ProcessPoolExecutor(max_workers=max_workers or min(n_replicas, os.cpu_count() or 1),
+                             initializer=_init_tempering_worker,
+                             initargs=(problem.snowfall_forecast,
+                                       graph_file if graph_file is not None else problem.road_layout, speeds,
+                                       problem.Tmax,
+                                       problem.danger_backend)) as executor:
+        for round_no in range(n_rounds):
+            futures = [executor.submit(_run_replica, states[k], temperatures[k], steps_per_round,
+                                       choose_neighbour_function, rng.randrange(2 ** 32))
+                       for k in range(n_replicas)]
+
+            for k, future in enumerate(futures):
+                result = future.result()
+                states[k] = result["route_ids"]
+                dangers[k] = result["danger"]
+                moves_accepted[k] += result["accepted"]
+                if result["best_danger"] < best_danger:
+                    best_danger = result["best_danger"]
+                    best_solution = result["best_route_ids"]
+
+            # Replica exchange between neighboring temperatures
+            for k in range(round_no % 2, n_replicas - 1, 2):
+                swap_attempts[k] += 1
+                exponent = (dangers[k] - dangers[k + 1]) * (1 / temperatures[k] - 1 / temperatures[k + 1])
+                if exponent >= 0 or rng.random() < math.exp(exponent):
+                    swap_accepted[k] += 1
+                    states[k], states[k + 1] = states[k + 1], states[k]
+                    dangers[k], dangers[k + 1] = dangers[k + 1], dangers[k]
+
+            danger_history.append(list(dangers))
+            best_danger_history.append(best_danger)
+
+    if best_solution is not None:
+        restore_routes(problem.machines, best_solution)
+
+    diagnostics = {
+        "temperatures": temperatures,
+        "swap_attempts": swap_attempts,
+        "swap_accepted": swap_accepted,
+        "swap_acceptance": [accepted / attempts if attempts else 0.0
+                            for accepted, attempts in zip(swap_accepted, swap_attempts)],
+        "move_acceptance": [accepted / (n_rounds * steps_per_round) if n_rounds * steps_per_round else 0.0
+                            for accepted in moves_accepted],
+        "danger_history": danger_history,
+        "best_danger_history": best_danger_history,
+    }
+    return problem.machines, best_danger, diagnostics
@@ -1,3 +1,7 @@
+import logging
+import queue
+import threading
+import time
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import matplotlib.pyplot as plt
@@ -5,8 +9,12 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from map_import import load_graph_from_file
 from solution import RoadClearingProblem, Machine
 from diagnostics import plot_diagnostic_charts
+from tracing import configure_logging
 from map_import import get_graph_of_city
 
+logger = logging.getLogger(__name__)
+
+
 class RoadClearingApp:
     def __init__(self, root):
         self.root = root
@@ -205,7 +213,20 @@ class RoadClearingApp:
 
         # Start button
         self.start_button = ttk.Button(left_frame, text="Start", command=self.run_optimization, style="Start.TButton")
-        self.start_button.grid(row=6, column=0, sticky="ew", pady=15)
+        self.start_button.grid(row=6, column=0, sticky="ew", pady=(15, 5))
+
+        # Cancel button - stops the running optimization and keeps the best solution found so far
+        self.cancel_button = ttk.Button(left_frame, text="Cancel", command=self.cancel_optimization, state="disabled")
+        self.cancel_button.grid(row=7, column=0, sticky="ew", pady=5)
+
+        # Progress of the running optimization
+        self.progress_label = ttk.Label(left_frame, text="")
+        self.progress_label.grid(row=8, column=0, sticky="w", pady=5)
+
+        # Optimization runs in a worker thread, which sends progress events through this queue
+        self.progress_queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.optimization_thread = None
 
         # Graph frame
         self.graph_frame = ttk.Frame(right_frame)
@@ -271,7 +292,7 @@ class RoadClearingApp:
 
             try:
                 self.road_graph = get_graph_of_city(self.selected_city.get(), custom_roads=["tertiary", "residential"])
-                print("Graph loaded")
+                logger.info("Graph loaded")
                 self.draw_graph()
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to load graph: {e}")
@@ -283,7 +304,7 @@ class RoadClearingApp:
         if file_path:
             try:
                 self.road_graph = load_graph_from_file(file_path)
-                print("Graph loaded")
+                logger.info("Graph loaded")
                 self.draw_graph()
                 messagebox.showinfo("Success", "File loaded successfully!")
             except Exception as e:
@@ -349,20 +370,92 @@ class RoadClearingApp:
             # Load neighborhood functions
             neighborhood_functions = [self.neighborhood_methods[method] for method in selected_methods]
 
-            problem = RoadClearingProblem(snowfall_forecast, self.road_graph, machines, Tmax)
-            best_solution, best_danger, diagnostics = problem.simulated_annealing(
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to run optimization: {e}")
+            return
+
+        self.stop_event.clear()
+        self.start_button.config(state="disabled")
+        self.cancel_button.config(state="normal")
+        self.progress_label.config(text="Starting...")
+
+        self.optimization_thread = threading.Thread(
+            target=self.optimization_worker,
+            args=(snowfall_forecast, self.road_graph, machines, Tmax, temperature, cooling_rate, max_iterations,
+                  neighborhood_functions),
+            daemon=True
+        )
+        self.optimization_thread.start()
+        self.root.after(100, self.poll_progress)
+
+    def optimization_worker(self, snowfall_forecast, road_graph, machines, Tmax, temperature, cooling_rate,
+                            max_iterations, neighborhood_functions):
+        """Runs the simulated annealing outside the Tk main thread, results are sent through progress_queue"""
+        last_report = [0.0]
+
+        def report_progress(event):
+            # Send at most ~10 progress events per second
+            now = time.perf_counter()
+            if now - last_report[0] >= 0.1:
+                last_report[0] = now
+                self.progress_queue.put(("progress", event))
+
+        try:
+            problem = RoadClearingProblem(snowfall_forecast, road_graph, machines, Tmax)
+            result = problem.simulated_annealing(
                 initial_temperature=temperature,
                 cooling_rate=cooling_rate,
                 max_iterations=max_iterations,
-                choose_neighbour_function=neighborhood_functions
+                choose_neighbour_function=neighborhood_functions,
+                progress_callback=report_progress,
+                stop_event=self.stop_event
             )
+            self.progress_queue.put(("done", result))
+        except Exception as e:
+            self.progress_queue.put(("error", e))
+
+    def poll_progress(self):
+        """Reads events from the worker thread (called periodically by root.after)"""
+        try:
+            while True:
+                kind, data = self.progress_queue.get_nowait()
+
+                if kind == "progress":
+                    self.progress_label.config(
+                        text=f"Iteration {data['iteration']} | danger {data['current_danger']} | "
+                             f"best {data['best_danger']}\nT = {data['temperature']:.4g} | "
+                             f"{data['iterations_per_second']:.1f} it/s"
+                    )
+
+                elif kind == "done":
+                    self.finish_optimization()
+                    best_solution, best_danger, diagnostics = data
+                    cancelled = " (cancelled)" if self.stop_event.is_set() else ""
+                    self.progress_label.config(text=f"Finished{cancelled}, best danger: {best_danger}")
+                    messagebox.showinfo("Optimization complete", f"Best danger level{cancelled}: {best_danger}")
+                    self.visualize_solution(diagnostics, best_solution)
+                    return
 
-            messagebox.showinfo("Optimization complete", f"Best danger level: {best_danger}")
+                elif kind == "error":
+                    self.finish_optimization()
+                    self.progress_label.config(text="")
+                    messagebox.showerror("Error", f"Failed to run optimization: {data}")
+                    return
 
-            self.visualize_solution(diagnostics, best_solution)
+        except queue.Empty:
+            pass
 
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to run optimization: {e}")
+        self.root.after(100, self.poll_progress)
+
+    def cancel_optimization(self):
+        self.stop_event.set()
+        self.cancel_button.config(state="disabled")
+        self.progress_label.config(text="Cancelling...")
+
+    def finish_optimization(self):
+        self.optimization_thread = None
+        self.start_button.config(state="normal")
+        self.cancel_button.config(state="disabled")
 
     def show_previous_solution(self):
         if self.solutions and self.current_solution_index > 0:
@@ -422,6 +515,7 @@ class RoadClearingApp:
         plot_diagnostic_charts(*diagnostics)
 
 if __name__ == "__main__":
+    configure_logging("INFO")
     root = tk.Tk()
     app = RoadClearingApp(root)
     root.mainloop()
@@ -0,0 +1,215 @@
+"""
+Headless (batch) solver - runs the optimization without the graphical interface.
+
+Usage:
+    python -m road_clearing_cli --layout road_layout.txt --forecast 3,4,5,6 --speeds 30,40 --tmax 1 \
+        --temperature 100 --cooling-rate 0.98 --iterations 1000 --output results
+
+    python -m road_clearing_cli --config job.json
+
+The config file is a JSON object with the same keys as the long options (with underscores, e.g. "cooling_rate"),
+options given on the command line override it. Results are written to the output directory:
+- result.json -> best danger, parameters and routes of all machines (edges as pairs of coordinates),
+- diagnostics.json -> danger, accepted danger, temperature and iteration number lists (decimated to at most
+  2 * --diagnostics-capacity points) or per-chain data for --chains > 1,
+- diagnostics.npy -> full-resolution history (rows: danger, accepted danger, temperature), only with
+  --full-diagnostics.
+
+Logging goes to stderr (--log-level, DEBUG logs every --log-every iteration), --trace writes the same sampled
+iterations as JSON lines for offline analysis.
+
+Neither tkinter nor matplotlib is imported.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+
+from map_import import load_graph_from_file, get_graph_of_city
+from graph_store import save_graph, load_graph, is_saved_graph
+from graph_contraction import ChainContraction
+from danger_simulation import IncrementalDangerEvaluator
+from solution import RoadClearingProblem, Machine
+from tracing import configure_logging, JsonlTraceSink
+from diagnostics_recorder import DIAGNOSTICS_CAPACITY
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "layout": None,
+    "city": None,
+    "forecast": None,
+    "speeds": None,
+    "tmax": None,
+    "temperature": 100.0,
+    "cooling_rate": 0.98,
+    "iterations": 1000,
+    "neighborhood": [0, 1, 2, 3],
+    "backend": "incremental",
+    "chains": 1,
+    "workers": None,
+    "seed": None,
+    "output": "results",
+    "log_level": "WARNING",
+    "log_every": 1,
+    "trace": None,
+    "diagnostics_capacity": DIAGNOSTICS_CAPACITY,
+    "full_diagnostics": False,
+    "precompute_detours": False,
+    "offline": False,
+    "save_graph": None,
+    "contract_chains": False,
+}
+
+
+def _number_list(text, number_type):
+    return [number_type(value) for value in text.strip("[]").split(",") if value.strip()]
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m road_clearing_cli",
+                                     description="Snowplow route optimization with simulated annealing (batch mode).")
+    parser.add_argument("--config", help="JSON file with parameters (command line options override it)")
+    parser.add_argument("--layout", help="text file with the street layout or a directory saved with --save-graph")
+    parser.add_argument("--city", help="city name for an OSM layout (see map_import.get_graph_of_city)")
+    parser.add_argument("--forecast", type=lambda text: _number_list(text, int), help="snowfall per stage, e.g. 3,4,5")
+    parser.add_argument("--speeds", type=lambda text: _number_list(text, float), help="machine speeds in km/h, e.g. 30,40")
+    parser.add_argument("--tmax", type=float, help="time between snowfalls (hours)")
+    parser.add_argument("--temperature", type=float, help="initial temperature")
+    parser.add_argument("--cooling-rate", dest="cooling_rate", type=float, help="cooling rate (0.95 - 0.99)")
+    parser.add_argument("--iterations", type=int, help="maximum number of iterations")
+    parser.add_argument("--neighborhood", type=lambda text: _number_list(text, int),
+                        help="neighborhood functions: 0 - MK1, 1 - MK2, 2 - SK1, 3 - SK2, e.g. 0,2")
+    parser.add_argument("--backend", choices=["incremental", "vectorized", "full"], help="danger evaluation backend")
+    parser.add_argument("--chains", type=int, help="number of independent annealing chains (multi-start)")
+    parser.add_argument("--workers", type=int, help="number of worker processes for --chains > 1")
+    parser.add_argument("--seed", type=int, help="random seed")
+    parser.add_argument("--output", help="output directory")
+    parser.add_argument("--log-level", dest="log_level", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="logging level (DEBUG - every logged iteration)")
+    parser.add_argument("--log-every", dest="log_every", type=int, help="log/trace every N-th iteration")
+    parser.add_argument("--trace", help="JSON lines file with sampled iterations (single chain only)")
+    parser.add_argument("--diagnostics-capacity", dest="diagnostics_capacity", type=int,
+                        help="number of buckets of the diagnostics history (longer runs are decimated)")
+    parser.add_argument("--full-diagnostics", dest="full_diagnostics", action="store_true", default=None,
+                        help="also stream the full-resolution history to diagnostics.npy (single chain only)")
+    parser.add_argument("--precompute-detours", dest="precompute_detours", action="store_true", default=None,
+                        help="find the detours of all edges (used by neighborhood function 3) up front in --workers "
+                             "processes (single chain only)")
+    parser.add_argument("--offline", action="store_true", default=None,
+                        help="load --city layouts only from the OSM cache, without querying OpenStreetMap")
+    parser.add_argument("--save-graph", dest="save_graph",
+                        help="save the loaded layout in the binary format (directory) for later --layout runs")
+    parser.add_argument("--contract-chains", dest="contract_chains", action="store_true", default=None,
+                        help="optimize on the layout with chains of degree-2 vertices contracted into single streets "
+                             "(routes are expanded back to the original streets in the results)")
+    args = parser.parse_args(argv)
+
+    params = dict(DEFAULTS)
+    if args.config:
+        with open(args.config, "r") as file:
+            params.update(json.load(file))
+    params.update({key: value for key, value in vars(args).items() if value is not None and key != "config"})
+
+    if not params["layout"] and not params["city"]:
+        parser.error("either --layout or --city is required")
+    for required in ("forecast", "speeds", "tmax"):
+        if not params[required]:
+            parser.error(f"--{required} is required")
+
+    return params
+
+
+def routes_to_json(machines):
+    return [{"speed": machine.speed,
+             "route": [[[[edge.start.x, edge.start.y], [edge.end.x, edge.end.y]] for edge in stage]
+                       for stage in machine.route]}
+            for machine in machines]
+
+
+def main(argv=None):
+    params = parse_arguments(argv)
+    configure_logging(params["log_level"])
+
+    if params["seed"] is not None:
+        random.seed(params["seed"])
+
+    graph_file = None  # Binary layout the chain workers can memory-map instead of receiving a pickled copy
+    if params["layout"] and is_saved_graph(params["layout"]):
+        road_layout = load_graph(params["layout"])
+        graph_file = params["layout"]
+    elif params["layout"]:
+        road_layout = load_graph_from_file(params["layout"])
+    else:
+        road_layout = get_graph_of_city(params["city"], offline=params["offline"])
+    if params["save_graph"]:
+        save_graph(road_layout, params["save_graph"])
+        graph_file = params["save_graph"]
+
+    contraction = None
+    if params["contract_chains"]:
+        contraction = ChainContraction(road_layout)
+        graph_file = None  # Workers need the contracted layout, not the saved one
+        logger.info("Contracted layout: {contracted_vertices} of {vertices} vertices, "
+                    "{contracted_edges} of {edges} edges".format(**contraction.info()))
+
+    machines = [Machine(speed=speed) for speed in params["speeds"]]
+    problem = RoadClearingProblem(params["forecast"], contraction.graph if contraction else road_layout, machines,
+                                  params["tmax"], danger_backend=params["backend"])
+
+    annealing_params = {
+        "initial_temperature": params["temperature"],
+        "cooling_rate": params["cooling_rate"],
+        "max_iterations": params["iterations"],
+        "choose_neighbour_function": params["neighborhood"],
+        "diagnostics_capacity": params["diagnostics_capacity"],
+    }
+
+    os.makedirs(params["output"], exist_ok=True)
+
+    start_time = time.perf_counter()
+    if params["chains"] > 1:
+        from parallel_annealing import multi_start_annealing
+        best_solution, best_danger, diagnostics = multi_start_annealing(
+            problem, n_chains=params["chains"], max_workers=params["workers"], seed=params["seed"],
+            graph_file=graph_file, **annealing_params)
+    else:
+        if params["precompute_detours"]:
+            problem.detour_cache.precompute(max_workers=params["workers"])
+        annealing_params["log_interval"] = params["log_every"]
+        if params["full_diagnostics"]:
+            annealing_params["diagnostics_stream"] = os.path.join(params["output"], "diagnostics.npy")
+        if params["trace"]:
+            with JsonlTraceSink(params["trace"]) as trace_sink:
+                best_solution, best_danger, diagnostics = problem.simulated_annealing(trace_sink=trace_sink,
+                                                                                      **annealing_params)
+        else:
+            best_solution, best_danger, diagnostics = problem.simulated_annealing(**annealing_params)
+    elapsed = time.perf_counter() - start_time
+
+    if contraction is not None:
+        # Routes on the original streets and their danger on the original layout
+        contraction.expand_machines(best_solution)
+        expanded_danger = IncrementalDangerEvaluator(road_layout, params["forecast"]).reset(best_solution)
+        if not math.isclose(expanded_danger, best_danger):
+            logger.warning("Danger on the original layout (%s) differs from the danger on the contracted one (%s)",
+                           expanded_danger, best_danger)
+        best_danger = expanded_danger
+
+    with open(os.path.join(params["output"], "result.json"), "w") as file:
+        json.dump({"best_danger": best_danger, "time": elapsed, "parameters": params,
+                   "machines": routes_to_json(best_solution)}, file, indent=2)
+    with open(os.path.join(params["output"], "diagnostics.json"), "w") as file:
+        json.dump(diagnostics, file)
+
+    print(f"Best danger level: {best_danger} ({elapsed:.1f} s), results saved in {params['output']}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
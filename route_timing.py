@@ -0,0 +1,78 @@
+"""
+Splitting routes into stages by travel time.
+
+Both functions walk the route once, keeping a running sum of travel times (prefix sum from the beginning
+of the current stage), so every edge is summed at most twice (once more if it overflows a stage and starts
+the next one). The sums are accumulated in the same order as before, so the partitions are identical.
+"""
+
+from array import array
+
+
+def stage_cut(edges, start, end, speed, Tmax):
+    """
+    Returns the index of the first edge in edges[start:end] whose cumulative travel time counted from start
+    exceeds Tmax (end if all of them fit) and the travel time of the edges before it.
+    """
+    time = 0
+    for idx in range(start, end):
+        new_time = time + edges[idx].length / speed
+        if new_time > Tmax:
+            return idx, time
+        time = new_time
+    return end, time
+
+
+def resegment_route(route, speed, Tmax, fits=None, edges=None):
+    """
+    Moves edges exceeding Tmax in a stage to the beginning of the next stage (edges of the last stage exceeding
+    Tmax are removed). Edges are never moved to an earlier stage.
+
+    :param route: list of stages (lists of edges, or arrays of edge IDs resolved through edges)
+    :param fits: function stage index -> True if the stage is known to fit into Tmax (e.g. from the stage time
+                 ledger of the machine), such stages are returned as they are when nothing is carried over into them
+    :param edges: edges of the layout indexed by ID, needed only for stages given as arrays of edge IDs
+    :return: list of stages after the adjustment
+    """
+    new_route = []
+    carried_over = []  # Edges cut off from the previous stage
+    for stage_idx, stage in enumerate(route):
+        if not carried_over and fits is not None and fits(stage_idx):
+            new_route.append(stage)
+            continue
+        if isinstance(stage, array):
+            stage = [edges[edge_id] for edge_id in stage]
+        stage = carried_over + stage
+        cut, _ = stage_cut(stage, 0, len(stage), speed, Tmax)
+        new_route.append(stage[:cut])
+        carried_over = stage[cut:]
+    return new_route
+
+
+def split_into_stages(edges, speed, Tmax, num_stages):
+    """
+    Divides a list of edges into num_stages stages of at most Tmax hours each, in order. A stage that is
+    started by an edge overflowing the previous one always contains that edge. Edges not fitting into
+    the last stage are dropped.
+
+    :return: stages, last_stage -> index of the stage of the last edge (num_stages if some edges were dropped,
+             0 for an empty route), stage_times -> travel time of every stage
+    """
+    stages = []
+    stage_times = []
+    start = 0
+    last_stage = 0
+    for stage in range(num_stages):
+        cut, time = stage_cut(edges, start, len(edges), speed, Tmax)
+        if stage > 0 and cut == start and start < len(edges):
+            cut = start + 1  # The edge which did not fit into the previous stage starts this one
+            time = edges[start].length / speed
+        stages.append(edges[start:cut])
+        stage_times.append(time)
+        if cut > start:
+            last_stage = stage
+        start = cut
+
+    if start < len(edges):
+        last_stage = num_stages
+    return stages, last_stage, stage_times
@@ -1,14 +1,156 @@
+import copy
+import logging
 import math
+import random
+import time
+from array import array
 import data_structures
 from typing import List, Union
-from neighborhood_SK import *
-from neighborhood_MK import *
+from danger_simulation import IncrementalDangerEvaluator, VectorizedDangerSimulator
+from moves import snapshot_routes, restore_routes
+from diagnostics_recorder import DiagnosticsRecorder, DIAGNOSTICS_CAPACITY
+from street_usage import StreetUsage
+from detour_cache import DetourCache
+from bypass_finder import BypassFinder
+from neighborhood_SK import generate_route_from_least_frequent, change_path
+from neighborhood_MK import neighbor_function_1, neighbor_function_2
+
+logger = logging.getLogger(__name__)
 
 
 class Machine:
     def __init__(self, speed=30):
         self.speed = speed  # In Km/h
-        self.route = []
+        self.road_layout = None  # Graph whose edges the route refers to
+
+        # Stage time ledger: travel time of every edge at this machine's speed and the time of every stage,
+        # kept in step with route_ids by the route_ids setter and replace_stages (used by RouteMove).
+        self._edge_times = None
+        self._edge_times_key = None
+        self._stage_times = None  # Stage -> travel time in hours, None -> computed on the next use
+        self._most_slack = None  # Index of the stage with the shortest time, None -> found on the next use
+        self.route_ids = []
+
+    @property
+    def route_ids(self):
+        """
+        Stages of the route as arrays of edge IDs (indices in road_layout.edges).
+
+        The stage time ledger follows the stage arrays, not their contents: a stage must be changed by assigning
+        the whole route (route_ids = ...) or by replace_stages, never by modifying the list or an array in place.
+        """
+        return self._route_ids
+
+    @route_ids.setter
+    def route_ids(self, stages):
+        self._route_ids = list(stages)
+        self._stage_times = None
+        self._most_slack = None
+
+    def edge_times(self):
+        """
+        Travel times (hours) of all edges of road_layout at the machine's speed, indexed by edge ID.
+        """
+        key = (self.speed, id(self.road_layout), self.road_layout.version)
+        if self._edge_times_key != key:
+            self._edge_times = [edge.length / self.speed for edge in self.road_layout.edges]
+            self._edge_times_key = key
+            self._stage_times = None
+            self._most_slack = None
+        return self._edge_times
+
+    def _ledger(self):
+        # Stage times, recomputed only after the whole route, the speed or the layout has changed
+        edge_times = self.edge_times()
+        if self._stage_times is None:
+            self._stage_times = [sum(edge_times[edge_id] for edge_id in stage) for stage in self._route_ids]
+        return self._stage_times
+
+    def replace_stages(self, first_stage, count, new_stages, new_times=None):
+        """
+        Replaces count stages from first_stage on with new_stages (arrays of edge IDs) and updates the ledger.
+
+        :param new_times: travel times of new_stages if already known (e.g. when a move is reverted)
+        :return: travel times of the replaced and of the new stages
+        """
+        stage_times = self._ledger()
+        if new_times is None:
+            edge_times = self._edge_times
+            new_times = [sum(edge_times[edge_id] for edge_id in stage) for stage in new_stages]
+        end = first_stage + count
+        old_times = stage_times[first_stage:end]
+
+        self._route_ids[first_stage:end] = new_stages
+        stage_times[first_stage:end] = new_times
+
+        most_slack = self._most_slack
+        if most_slack is not None:
+            if len(new_stages) != count or first_stage <= most_slack < end:
+                self._most_slack = None  # Indices shifted or the shortest stage was replaced - found again on use
+            else:
+                for stage, time in enumerate(new_times, first_stage):
+                    if time < stage_times[most_slack] or (time == stage_times[most_slack] and stage < most_slack):
+                        most_slack = stage
+                self._most_slack = most_slack
+        return old_times, new_times
+
+    def stage_time(self, stage):
+        """
+        Travel time of the stage (hours), read from the ledger.
+        """
+        return self._ledger()[stage]
+
+    def stage_times(self):
+        return list(self._ledger())
+
+    def stage_slack(self, stage, Tmax):
+        """
+        Time left in the stage before Tmax is reached (negative if the stage exceeds Tmax).
+        """
+        return Tmax - self.stage_time(stage)
+
+    def fits_in_stage(self, stage, extra_time, Tmax):
+        """
+        Whether extra_time hours can be added to the stage without exceeding Tmax.
+        """
+        return self.stage_time(stage) + extra_time <= Tmax
+
+    def stage_with_most_slack(self):
+        """
+        Index of the stage with the shortest travel time (None for an empty route). Kept up to date
+        by replace_stages, all stages are compared only after the shortest one was replaced.
+        """
+        if not self._route_ids:
+            return None
+        stage_times = self._ledger()
+        if self._most_slack is None:
+            self._most_slack = min(range(len(stage_times)), key=stage_times.__getitem__)
+        return self._most_slack
+
+    def stage_edges(self, stage):
+        """
+        Edges (Edge objects) of one stage as a new list.
+        """
+        edges = self.road_layout.edges
+        return [edges[edge_id] for edge_id in self._route_ids[stage]]
+
+    @property
+    def route(self):
+        """
+        Route as a list of stages (lists of Edge objects) resolved from route_ids.
+
+        A materialized view - every access builds new lists of all edges of the route, and the setter converts
+        them back to arrays, so it is meant for output and debugging. Neighborhood functions read route_ids
+        (stage_edges for the stages they change) and replace stages with apply_route.
+        """
+        if not self.route_ids:
+            return []
+        edges = self.road_layout.edges
+        return [[edges[edge_id] for edge_id in stage] for stage in self.route_ids]
+
+    @route.setter
+    def route(self, stages):
+        self.route_ids = [array('i', [edge.id for edge in stage]) for stage in stages]
 
     def generate_initial_route(self, road_layout, Tmax, number_of_stages, consider_priority=False):
         """
@@ -20,10 +162,12 @@ class Machine:
             number_of_stages: Number of snowfall stages to plan for
             consider_priority: Whether to consider road priorities in route selection
         """
-        self.route = []
+        self.road_layout = road_layout
+        route = []
 
         current_location = road_layout.baza
         previous_location = None
+        stage_times = []
 
         for stage_no in range(number_of_stages):
             time_cost = 0
@@ -58,7 +202,7 @@ class Machine:
                     selected_edge = road_layout.get_edge(current_location, next_location)
 
                 # Calculate new time cost
-                new_time_cost = time_cost + selected_edge.calculate_length() / self.speed
+                new_time_cost = time_cost + selected_edge.length / self.speed
 
                 # Check if adding this edge would exceed time limit
                 if new_time_cost >= Tmax:
@@ -74,7 +218,13 @@ class Machine:
                 if current_location == road_layout.baza and len(stage_route) > 0:
                     break
 
-            self.route.append(stage_route)
+            route.append(stage_route)
+            stage_times.append(time_cost)
+
+        self.route = route
+        # The stage times are already known - fill the ledger
+        self.edge_times()
+        self._stage_times = stage_times
 
 
 class RoadClearingProblem:
@@ -82,7 +232,8 @@ class RoadClearingProblem:
                  snowfall_forecast: List[int],
                  road_layout: data_structures.Graph,
                  machines: List[Machine],
-                 Tmax: Union[int, float]):
+                 Tmax: Union[int, float],
+                 danger_backend: str = "incremental"):
 
         self.snowfall_forecast = snowfall_forecast
         self.road_layout = road_layout
@@ -90,89 +241,201 @@ class RoadClearingProblem:
         self.danger = float("inf")
         self.Tmax = Tmax  # In hours
 
-        self.get_initial_path()
+        for machine in self.machines:
+            machine.road_layout = road_layout
+
+        # "full" -> simulate_danger on every iteration, "incremental" -> delta evaluation of changed streets only,
+        # "vectorized" -> NumPy simulation of the whole solution
+        self.danger_backend = danger_backend
+        if danger_backend == "incremental":
+            self.danger_evaluator = IncrementalDangerEvaluator(road_layout, snowfall_forecast)
+        elif danger_backend == "vectorized":
+            self.danger_evaluator = VectorizedDangerSimulator(road_layout, snowfall_forecast)
+        elif danger_backend == "full":
+            self.danger_evaluator = None
+        else:
+            raise ValueError(f"Unknown danger backend: {danger_backend}")
+
+        # Street usage of the machines for the least-frequent neighborhood function, synchronized on every call
+        self.street_usage = StreetUsage(road_layout, machines)
+        # Detours of removed edges for change_path, found once per edge (DetourCache.precompute fills it up front)
+        self.detour_cache = DetourCache(road_layout)
+        # Bypass search of neighbor_function_1 with its hop index and memo of failed searches
+        self.bypass_finder = BypassFinder(road_layout)
 
-        solutions = [machine.route for machine in self.machines]
+        self.get_initial_path()
 
-        for route in solutions:
-            print(route, '\n')
+        if logger.isEnabledFor(logging.DEBUG):
+            for machine in self.machines:
+                logger.debug("Initial route: %s", machine.route)
 
     def get_initial_path(self):
         for machine in self.machines:
             machine.generate_initial_route(self.road_layout, self.Tmax, len(self.snowfall_forecast))
 
-    def simulated_annealing(self, initial_temperature, cooling_rate, max_iterations, choose_neighbour_function=None):
+    def simulated_annealing(self, initial_temperature, cooling_rate, max_iterations, choose_neighbour_function=None,
+                            progress_callback=None, stop_event=None, log_interval=1, trace_sink=None,
+                            diagnostics_capacity=DIAGNOSTICS_CAPACITY, diagnostics_stream=None):
         # Calculate initial danger based on the current - initial solution
         '''
         :param initial_temperature:
         :param cooling_rate:
         :param max_iterations:
+        :param progress_callback: function called after every iteration with a dictionary:
+                                  iteration, new_danger, current_danger, best_danger, temperature, iterations_per_second
+        :param stop_event: object with is_set() (e.g. threading.Event) - when set, the run stops
+                           and the best solution found so far is returned
+        :param log_interval: every how many iterations the iteration is logged (DEBUG level) and traced
+        :param trace_sink: object with write(record) (e.g. tracing.JsonlTraceSink) receiving sampled iteration records
+        :param diagnostics_capacity: number of buckets of the diagnostics history - longer runs are decimated
+                                     (minimum and maximum of every bucket are kept), see DiagnosticsRecorder
+        :param diagnostics_stream: .npy file receiving the full-resolution history (memory-mapped), None -> no file
         :return: best_solution, best_danger, diagnostics -> list containing 4 lists:
                  first list -> history of generated dangers
-                 second list -> history of best dangers
+                 second list -> history of accepted dangers
                  third list -> temperature history
+                 fourth list -> iteration numbers of the points of every series (list of 3 lists, 0 -> initial
+                 solution), after decimation the extremes of the series lie at different iterations
         '''
 
-        current_danger = self.simulate_danger()
+        current_danger = self.evaluate_danger(reset=True)
         best_danger = current_danger
 
         temperature = initial_temperature
 
-        diagnostics = [[best_danger], [best_danger], [temperature]]
+        diagnostics = DiagnosticsRecorder(capacity=diagnostics_capacity, stream_path=diagnostics_stream,
+                                          stream_length=max_iterations + 1)
+        diagnostics.record(best_danger, best_danger, temperature)
 
-        actual_solution = copy.deepcopy(self.machines)  # current solution
-        best_solution = copy.deepcopy(self.machines)
+        # The current solution is kept in self.machines and modified in place by moves,
+        # the best one is stored as a snapshot of edge IDs
+        best_solution = snapshot_routes(self.machines)
 
         if choose_neighbour_function is None or set(choose_neighbour_function) == {0, 1, 2, 3}:  # use all neighborhood functions simultaneously
             choose_neighbour_function = [4]
 
+        start_time = time.perf_counter()
+
+        # Checked once - disabled logging costs nothing inside the loop
+        log_iterations = logger.isEnabledFor(logging.DEBUG)
+        sample_iterations = log_iterations or trace_sink is not None
+        log_interval = max(1, log_interval)
+        logger.info("Simulated annealing: initial danger %s, initial temperature %s", current_danger, temperature)
+
         for iteration in range(max_iterations):
-            print("\n")
-            print("-----ITERATION ", iteration, "-------")
+            if stop_event is not None and stop_event.is_set():
+                logger.info("Termination requested by the user!")
+                break
 
             # Generate neighboring solution
-            self.generate_neighbor(temperature, choose_neighbour_function)
+            move = self.generate_neighbor(temperature, choose_neighbour_function)
 
             # Simulate new solution and calculate danger
-            new_danger = self.simulate_danger()
-            print("NEW DANGER -> ", new_danger)
+            new_danger = self.evaluate_danger(move=move)
 
             # Calculate danger difference
             delta_danger = new_danger - current_danger
-            print("Danger difference: ", delta_danger)
 
             # Accept solution based on Boltzmann function
             if delta_danger < 0 or random.random() < math.exp(-delta_danger / temperature):
-                actual_solution = copy.deepcopy(self.machines)
                 current_danger = new_danger
+                if self.danger_evaluator is not None:
+                    self.danger_evaluator.commit()
 
                 # Update best solution
                 if new_danger < best_danger:
-                    best_solution = copy.deepcopy(actual_solution)
+                    best_solution = snapshot_routes(self.machines)
                     best_danger = new_danger
 
-            else:
+            elif move is not None:
                 # Otherwise, revert to the current solution
-                self.machines = actual_solution
+                move.revert()
 
                 # Cool down temperature
             temperature *= cooling_rate
 
-            diagnostics[0].append(new_danger)
-            diagnostics[1].append(current_danger)
-            diagnostics[2].append(temperature)
+            diagnostics.record(new_danger, current_danger, temperature)
+
+            if sample_iterations and iteration % log_interval == 0:
+                if log_iterations:
+                    logger.debug("Iteration %d: new danger %s, danger difference %s, current %s, best %s, T = %s",
+                                 iteration, new_danger, delta_danger, current_danger, best_danger, temperature)
+                if trace_sink is not None:
+                    trace_sink.write({"iteration": iteration, "new_danger": new_danger, "delta_danger": delta_danger,
+                                      "current_danger": current_danger, "best_danger": best_danger,
+                                      "temperature": temperature, "move": repr(move)})
+
+            if progress_callback is not None:
+                elapsed = time.perf_counter() - start_time
+                progress_callback({
+                    "iteration": iteration + 1,
+                    "new_danger": new_danger,
+                    "current_danger": current_danger,
+                    "best_danger": best_danger,
+                    "temperature": temperature,
+                    "iterations_per_second": (iteration + 1) / elapsed if elapsed > 0 else 0.0,
+                })
 
             # Termination condition
             if temperature < 1e-3:
-                print("Termination due to low temperature!")
+                logger.info("Termination due to low temperature!")
                 break
 
             if best_danger == 0:
-                print("Termination by zeroing the objective function")
+                logger.info("Termination by zeroing the objective function")
                 break
 
-        self.machines = best_solution
-        return best_solution, best_danger, diagnostics
+        logger.info("Simulated annealing finished: best danger %s", best_danger)
+        restore_routes(self.machines, best_solution)
+        return self.machines, best_danger, diagnostics.series()
+
+    def sample_at_temperature(self, temperature, steps, choose_neighbour_function=None):
+        """
+        Runs Metropolis steps at a constant temperature, starting from the current solution (self.machines).
+        Used by parallel tempering, where every replica keeps its own temperature.
+        :return: current_danger, best_solution (snapshot of edge IDs), best_danger, number of accepted moves
+        """
+        if choose_neighbour_function is None or set(choose_neighbour_function) == {0, 1, 2, 3}:
+            choose_neighbour_function = [4]
+
+        current_danger = self.evaluate_danger(reset=True)
+        best_danger = current_danger
+        best_solution = snapshot_routes(self.machines)
+        accepted = 0
+
+        for _ in range(steps):
+            move = self.generate_neighbor(temperature, choose_neighbour_function)
+            new_danger = self.evaluate_danger(move=move)
+            delta_danger = new_danger - current_danger
+
+            if delta_danger < 0 or random.random() < math.exp(-delta_danger / temperature):
+                current_danger = new_danger
+                accepted += 1
+                if self.danger_evaluator is not None:
+                    self.danger_evaluator.commit()
+
+                if new_danger < best_danger:
+                    best_solution = snapshot_routes(self.machines)
+                    best_danger = new_danger
+
+            elif move is not None:
+                move.revert()
+
+        return current_danger, best_solution, best_danger, accepted
+
+    def evaluate_danger(self, reset=False, move=None):
+        """
+        Calculates the danger of the current solution using the selected backend.
+        With the incremental backend the result is kept as a pending proposal until it is committed,
+        unless reset=True, which evaluates the whole solution and makes it the current state.
+        If the move that produced the solution is given, only the stages it changed are compared.
+        :return: Total danger level.
+        """
+        if self.danger_evaluator is None:
+            return self.simulate_danger()
+        if reset:
+            return self.danger_evaluator.reset(self.machines)
+        return self.danger_evaluator.propose(self.machines, move)
 
     def simulate_danger(self):
         """
@@ -186,15 +449,14 @@ class RoadClearingProblem:
         total_danger = 0
 
         for stage in range(len(self.snowfall_forecast)):
-            # List of cleared streets by all machines in the current stage
-            cleared_streets = []
+            # Set of streets (street IDs) cleared by all machines in the current stage
+            cleared_streets = set()
             for m in self.machines:
-                for street in m.route[stage]:
-                    if street not in cleared_streets:
-                        cleared_streets.append(street)
+                for edge_id in m.route_ids[stage]:
+                    cleared_streets.add(graph_start.edges[edge_id].street_id)
 
             for street in graph_start.edges:
-                if street in cleared_streets:  # Check if the street has been cleared
+                if street.street_id in cleared_streets:  # Check if the street has been cleared
                     street.snow_level = 0  # Street has been cleared
                 else:
                     street.snow_level += self.snowfall_forecast[
@@ -209,6 +471,7 @@ class RoadClearingProblem:
     def generate_neighbor(self, actual_temperature, choose_neighbour_function):
         """
         Generates a new solution by using specific neighborhood functions.
+        :return: RouteMove applied to self.machines or None if the solution did not change.
         """
         graph_complexity = len(self.road_layout.edges)  # Number of edges/roads in the graph - describes complexity
 
@@ -277,7 +540,7 @@ class RoadClearingProblem:
                 choose_f = f_using[0]
 
             else:
-                print(
+                logger.error(
                     '''No neighborhood function provided!
                     Available:
                     0, 1, 2, 3 -> specific neighborhood functions
@@ -295,7 +558,7 @@ class RoadClearingProblem:
                 choose_f = random.choice(f_using)
 
             else:
-                print(
+                logger.error(
                     '''No neighborhood function provided!
                     Available:
                     0, 1, 2, 3 -> specific neighborhood functions
@@ -306,32 +569,36 @@ class RoadClearingProblem:
                     For multiple choices -> e.g., [0, 2]
                     '''
                 )
-        print(choose_f)
+        logger.debug("Neighborhood function: %d", choose_f)
         # --- Used neighborhood functions ---
 
         if choose_f == 0:  # modify_route_avoiding_vertex
-            neighbor_function_1(self.machines, search_depth, self.road_layout, self.Tmax)
+            move = neighbor_function_1(self.machines, search_depth, self.road_layout, self.Tmax,
+                                       bypass_finder=self.bypass_finder)
             '''
             Modifies the existing route of a machine by avoiding one vertex, depending on the 'search_depth' parameter
             (the higher the parameter, the more diverse the new solution).
             '''
 
         elif choose_f == 1:  # reconstruct_route_from_stage
-            neighbor_function_2(self.machines, self.road_layout, self.Tmax, param2)
+            move = neighbor_function_2(self.machines, self.road_layout, self.Tmax, param2)
             '''
             Reconstructs the route from a randomly selected stage, with the possibility of significant changes if early stages are selected.
             '''
 
         elif choose_f == 2:
-            generate_route_from_least_frequent(self.machines, self.road_layout, self.Tmax)
+            move = generate_route_from_least_frequent(self.machines, self.road_layout, self.Tmax,
+                                                      street_usage=self.street_usage)
             '''
             Generates a route from the base to the least frequented street and optionally adds streets to fill the time.
             Possibility of introducing larger changes.
             '''
 
         elif choose_f == 3:
-            change_path(self.machines, self.road_layout, self.Tmax)
+            move = change_path(self.machines, self.road_layout, self.Tmax, detour_cache=self.detour_cache)
             '''
             Modifies the machine's route by removing one edge and replacing it with a new route repaired by the A* algorithm.
             Moves edges to the next stage if Tmax is exceeded.
             '''
+
+        return move
@@ -0,0 +1,104 @@
+"""
+Street usage counts of the machines, kept up to date between calls of the least-frequent neighborhood function.
+
+StreetUsage counts how many times every machine clears every street (street_id) over all stages. Like
+IncrementalDangerEvaluator it keeps a snapshot of the stage arrays and, when synchronized, recounts only
+the stages that were replaced since the last call (moves replace whole stage arrays, so unchanged stages are
+recognized by identity). Every machine has a heap of (usage by the other machines, edge ID) entries with lazy
+deletion, so the least used edges come out in the same order as from sorting all edges by usage.
+"""
+
+import heapq
+
+
+class StreetUsage:
+    def __init__(self, road_layout, machines):
+        self.road_layout = road_layout
+        self.machines = machines
+        self.edge_street = [edge.street_id for edge in road_layout.edges]
+        num_streets = max(self.edge_street, default=-1) + 1
+
+        self.street_edges = [[] for _ in range(num_streets)]  # street_id -> IDs of its edges (both directions)
+        for edge_id, street_id in enumerate(self.edge_street):
+            self.street_edges[street_id].append(edge_id)
+
+        self.counts = [[0] * num_streets for _ in machines]  # machine index -> street_id -> number of clearings
+        self.total = [0] * num_streets  # street_id -> number of clearings by all machines
+        self.snapshots = [[] for _ in machines]  # Stages (arrays of edge IDs) the counts were computed from
+        self.heaps = [None] * len(machines)  # machine index -> heap of (usage by the others, edge ID)
+        self.max_priority = max((edge.priority for edge in road_layout.edges), default=0)
+
+    def other_usage(self, machine_index, street_id):
+        """
+        Number of times the street is cleared by the machines other than machine_index.
+        """
+        return self.total[street_id] - self.counts[machine_index][street_id]
+
+    def _build_heap(self, machine_index):
+        heap = [(self.other_usage(machine_index, street_id), edge_id)
+                for edge_id, street_id in enumerate(self.edge_street)]
+        heapq.heapify(heap)
+        self.heaps[machine_index] = heap
+
+    def sync(self):
+        """
+        Updates the counts from the current routes of the machines.
+        """
+        for i, machine in enumerate(self.machines):
+            old_route, new_route = self.snapshots[i], machine.route_ids
+            changed_streets = set()
+            for stage in range(max(len(old_route), len(new_route))):
+                old_stage = old_route[stage] if stage < len(old_route) else ()
+                new_stage = new_route[stage] if stage < len(new_route) else ()
+                if old_stage is new_stage or old_stage == new_stage:
+                    continue
+                for edge_id in old_stage:
+                    street_id = self.edge_street[edge_id]
+                    self.counts[i][street_id] -= 1
+                    self.total[street_id] -= 1
+                    changed_streets.add(street_id)
+                for edge_id in new_stage:
+                    street_id = self.edge_street[edge_id]
+                    self.counts[i][street_id] += 1
+                    self.total[street_id] += 1
+                    changed_streets.add(street_id)
+
+            self.snapshots[i] = list(new_route)
+            if not changed_streets:
+                continue
+
+            # Usage by the others changed for every machine except machine i - push the new entries,
+            # the outdated ones are skipped when popped
+            for j, heap in enumerate(self.heaps):
+                if j == i or heap is None:
+                    continue
+                for street_id in changed_streets:
+                    usage = self.other_usage(j, street_id)
+                    for edge_id in self.street_edges[street_id]:
+                        heapq.heappush(heap, (usage, edge_id))
+                if len(heap) > 4 * len(self.edge_street):
+                    self._build_heap(j)  # Too many outdated entries
+
+    def least_used_edges(self, machine_index):
+        """
+        Generator of edge IDs ordered by the usage of their streets by the other machines, ties by edge ID
+        (the same order as a stable sort of road_layout.edges by usage).
+        Entries are popped only as far as the caller iterates and are pushed back when the generator is closed.
+        """
+        if self.heaps[machine_index] is None:
+            self._build_heap(machine_index)
+        heap = self.heaps[machine_index]
+
+        popped = []
+        seen = set()
+        try:
+            while heap:
+                usage, edge_id = heapq.heappop(heap)
+                if edge_id in seen or usage != self.other_usage(machine_index, self.edge_street[edge_id]):
+                    continue  # Duplicate or outdated entry - dropped
+                seen.add(edge_id)
+                popped.append((usage, edge_id))
+                yield edge_id
+        finally:
+            for entry in popped:
+                heapq.heappush(heap, entry)
@@ -0,0 +1,46 @@
+"""
+Logging and tracing of the optimization.
+
+Modules log through the standard logging module (logging.getLogger(__name__)):
+- DEBUG -> per-iteration information (danger, chosen neighborhood function, "no change" of a neighborhood function),
+- INFO -> start/termination of the annealing,
+- WARNING -> problems with input data.
+In the annealing loop the enabled levels are checked once before the loop, so disabled levels cost nothing.
+
+JsonlTraceSink writes sampled iteration records as JSON lines for offline analysis.
+"""
+
+import json
+import logging
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def configure_logging(level="WARNING", log_file=None):
+    """
+    Sets up logging of the whole application (level name or number, optional log file instead of stderr).
+    """
+    logging.basicConfig(level=level, format=LOG_FORMAT, filename=log_file, force=True)
+
+
+class JsonlTraceSink:
+    """
+    Writes one JSON object per line to a file. Can be used as a context manager.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "w")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()